@@ -0,0 +1,146 @@
+"""
+Compares the plans and timings of the hot Session queries before and after
+migration 0015_session_active, on a table full of closed sessions.
+
+Run it with the settings of the database to test, e.g.::
+
+    DJANGO_SETTINGS_MODULE=decisiontree.tests.settings \\
+        python benchmarks/session_indexes.py --sessions 1000000
+
+It works in a separate test database, which is created and destroyed by
+Django's test machinery, so it never touches real data.
+"""
+
+import argparse
+import datetime
+import random
+import timeit
+
+import django
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.test.utils import get_runner
+
+
+BEFORE = ('decisiontree', '0014_tree_snapshot')
+AFTER = ('decisiontree', '0015_session_active')
+
+
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    prefix = {
+        'sqlite': 'EXPLAIN QUERY PLAN ',
+        'postgresql': 'EXPLAIN ',
+    }.get(connection.vendor, 'EXPLAIN ')
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        if connection.vendor == 'sqlite':
+            # (id, parent, notused, detail)
+            return [row[-1] for row in cursor.fetchall()]
+        return [' '.join(str(col) for col in row) for row in cursor.fetchall()]
+
+
+def migrate(target):
+    from django.db.migrations.executor import MigrationExecutor
+    executor = MigrationExecutor(connection)
+    executor.migrate([target])
+    executor.loader.build_graph()
+    return executor.loader.project_state(target).apps
+
+
+def populate(apps, closed, connections, batch_size=5000):
+    Backend = apps.get_model('rapidsms', 'Backend')
+    Connection = apps.get_model('rapidsms', 'Connection')
+    Message = apps.get_model('decisiontree', 'Message')
+    TreeState = apps.get_model('decisiontree', 'TreeState')
+    Tree = apps.get_model('decisiontree', 'Tree')
+    Session = apps.get_model('decisiontree', 'Session')
+
+    backend = Backend.objects.create(name='benchmark')
+    Connection.objects.bulk_create([
+        Connection(backend=backend, identity=str(i)) for i in range(connections)])
+    connection_ids = list(Connection.objects.values_list('pk', flat=True))
+    state = TreeState.objects.create(
+        name='question', message=Message.objects.create(text='?'))
+    tree = Tree.objects.create(trigger='benchmark', root_state=state)
+
+    start = datetime.datetime(2015, 1, 1)
+    batch = []
+    for i in range(closed):
+        batch.append(Session(
+            connection_id=connection_ids[i % connections], tree=tree,
+            start_date=start + datetime.timedelta(minutes=i), state=None,
+            state_at_close=state, num_tries=0, canceled=(i % 10 == 0)))
+        if len(batch) == batch_size:
+            Session.objects.bulk_create(batch)
+            batch = []
+    # one open session for every tenth connection
+    now = start + datetime.timedelta(minutes=closed)
+    batch.extend(Session(connection_id=pk, tree=tree, start_date=now, state=state,
+                         num_tries=0, timeout_at=now)
+                 for pk in connection_ids[::10])
+    Session.objects.bulk_create(batch)
+    # auto_now_add overrode the start dates
+    for offset in range(0, closed, batch_size):
+        Session.objects.filter(pk__gt=offset, pk__lte=offset + batch_size).update(
+            start_date=start + datetime.timedelta(minutes=offset))
+    return connection_ids
+
+
+def queries(apps, connection_id, migrated):
+    Session = apps.get_model('decisiontree', 'Session')
+    sessions = Session.objects.exclude(Q(state=None) | Q(canceled=True))
+    if migrated:
+        sessions = sessions.filter(active=True)
+    now = datetime.datetime(2100, 1, 1)
+    return [
+        ('latest open session of a connection',
+         sessions.filter(connection=connection_id).order_by('-start_date', '-pk')[:1]),
+        ('due sessions',
+         sessions.filter(timeout_at__lte=now).order_by('timeout_at', 'pk')[:500]),
+    ]
+
+
+def report(apps, connection_ids, migrated, repeat):
+    for name, queryset in queries(apps, connection_ids[0], migrated):
+        print('  %s' % name)
+        for line in explain(queryset):
+            print('    %s' % line)
+
+        def run():
+            for connection_id in random.sample(connection_ids, 10):
+                for n, qs in queries(apps, connection_id, migrated):
+                    if n == name:
+                        list(qs)
+        seconds = min(timeit.repeat(run, number=1, repeat=repeat)) / 10
+        print('    %.3f ms per query' % (seconds * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sessions', type=int, default=1000000,
+                        help='number of closed sessions')
+    parser.add_argument('--connections', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    django.setup()
+    runner = get_runner(settings)(verbosity=0)
+    old_config = runner.setup_databases()
+    try:
+        apps = migrate(BEFORE)
+        connection_ids = populate(apps, args.sessions, args.connections)
+        print('before (%s):' % BEFORE[1])
+        report(apps, connection_ids, False, args.repeat)
+        start = timeit.default_timer()
+        apps = migrate(AFTER)
+        print('migrating took %.1f s' % (timeit.default_timer() - start))
+        print('after (%s):' % AFTER[1])
+        report(apps, connection_ids, True, args.repeat)
+    finally:
+        runner.teardown_databases(old_config)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,3 +4,5 @@ SMS based on a database-configurable decision tree.
 """
 
 __version__ = '0.1.0dev'
+
+default_app_config = "decisiontree.apps.DecisionTreeConfig"
@@ -5,6 +5,7 @@ from decisiontree import models
 
 class TreeAdmin(admin.ModelAdmin):
     list_display = ('trigger', '_root_state', '_summary')
+    readonly_fields = ('_loop',)
 
     def _root_state(self, obj):
         return obj.root_state.message.text
@@ -14,6 +15,15 @@ class TreeAdmin(admin.ModelAdmin):
         return obj.summary
     _summary.short_description = 'Description'
 
+    def _loop(self, obj):
+        if not obj or not obj.root_state_id:
+            return ''
+        states = obj.find_loop()
+        if not states:
+            return 'None'
+        return ' -> '.join(state.name for state in states + states[:1])
+    _loop.short_description = 'Loop'
+
 
 class MessageAdmin(admin.ModelAdmin):
     list_display = ('text', 'id')
@@ -81,6 +91,16 @@ class SessionAdmin(admin.ModelAdmin):
     list_display = ('id', 'connection', 'tree', 'canceled')
 
 
+class ArchivedSessionAdmin(admin.ModelAdmin):
+    list_display = ('session_id', 'connection', 'tree', 'start_date', 'archived')
+    raw_id_fields = ('connection',)
+
+
+class StateAnswerStatsAdmin(admin.ModelAdmin):
+    list_display = ('tree', 'state', 'answer', 'count', 'last_updated')
+    list_filter = ('tree',)
+
+
 admin.site.register(models.Tree, TreeAdmin)
 admin.site.register(models.Message, MessageAdmin)
 admin.site.register(models.Answer, AnswerAdmin)
@@ -90,3 +110,5 @@ admin.site.register(models.Tag, TagAdmin)
 admin.site.register(models.TagNotification, TagNotificationAdmin)
 admin.site.register(models.Entry, EntryAdmin)
 admin.site.register(models.Session, SessionAdmin)
+admin.site.register(models.ArchivedSession, ArchivedSessionAdmin)
+admin.site.register(models.StateAnswerStats, StateAnswerStatsAdmin)
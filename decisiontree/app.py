@@ -1,25 +1,38 @@
 import datetime
 import logging
 import re
+from collections import OrderedDict
 
+from django.db import transaction
+from django.db.models import BooleanField, Case, DateTimeField, F, IntegerField, Value, When
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 
 from rapidsms.apps.base import AppBase
 from rapidsms.messages import OutgoingMessage, IncomingMessage
 from rapidsms.models import Connection
+from rapidsms.router.api import send
 
+from . import compiled
 from . import conf
-from .models import Entry, Session, TagNotification, Transition
+from . import session_cache
+from .models import Entry, Session, StateAnswerStats, TagNotification
+from .multitenancy.utils import multitenancy_enabled
+from .scheduler import TimeoutScheduler
 from .signals import session_end_signal
 from .utils import get_survey
 
 
 logger = logging.getLogger(__name__)
 
+# The answer given on behalf of a caller whose question has timed out.
+TIMEOUT_TEXT = "TimeOut"
+
 
 class App(AppBase):
     registered_functions = {}
     session_listeners = {}
+    scheduler = TimeoutScheduler()
 
     def handle(self, msg):
         '''
@@ -38,17 +51,21 @@ class App(AppBase):
             self.start_tree(survey, msg.connection, msg)
             return True 
 
-        sessions = msg.connection.session_set.open().select_related('state')
-        if not survey and sessions.count() == 0:
+        # the connection's open session, if any, is cached
+        pointer = session_cache.get_pointer(msg.connection)
+        if not pointer:
             logger.info('Tree not found: %s', msg.text)
 
             return False
 
         # the caller is part-way though a question
         # tree, so check their answer and respond
-        session = sessions.latest('start_date')
-        state = session.state
-        logger.debug(state)
+        state = compiled.get_state(pointer.tree_id, pointer.state_id)
+        if state is None:
+            # the state was deleted since the pointer was cached
+            session_cache.clear_pointer(msg.connection.pk)
+            return self.handle(msg)
+        logger.debug(state.name)
 
         # By default, rapidsms-decisiontree-app assigns the value "end" 
         # to this variable (see conf.py).
@@ -56,114 +73,263 @@ class App(AppBase):
         # before the `decisiontree` app can.
         end_trigger = conf.SESSION_END_TRIGGER
         if end_trigger is not None and msg.text == end_trigger:
+            session = self._get_session(pointer)
+            if not session:
+                return self.handle(msg)
             response = _("Your session with '%s' has ended")
-            msg.respond(response % session.tree.trigger)
+            msg.respond(response % compiled.get_tree(pointer.tree_id).trigger)
             self._end_session(session, True, message=msg)
             return True
 
-        # loop through all transitions starting with
-        # this state and try each one depending on the type
-        # this will be a greedy algorithm and NOT safe if
-        # multiple transitions can match the same answer
-        transitions = Transition.objects.filter(current_state=state)
-        found_transition = None
-        for transition in transitions:
-            if self.matches(transition.answer, msg):
-                found_transition = transition
-                break
+        # find the first transition starting with this state whose
+        # answer matches; this will be a greedy algorithm and NOT safe
+        # if multiple transitions can match the same answer
+        found_transition = state.matcher.match(msg.text, msg, self.registered_functions)
 
         # not a valid answer, so remind the user of the valid options.
         if not found_transition:
-            if transitions.count() == 0:
+            if not state.transitions:
+                session = self._get_session(pointer)
+                if not session:
+                    return self.handle(msg)
                 logger.error('No messages found!')
                 msg.respond(_("No messages found"))
                 self._end_session(session, message=msg)
-            else:
-                # update the number of times the user has tried
-                # to answer this.  If they have reached the
-                # maximum allowed then end their session and
-                # send them an error message.
-                session.num_tries = session.num_tries + 1
-                if state.num_retries is not None:
-                    if session.num_tries >= state.num_retries:
-                        session.state = None
-                        msg.respond("Sorry, invalid answer %d times. "
-                                    "Your session will now end. Please try again "
-                                    "later." % session.num_tries)
-                # send them some hints about how to respond
-                elif state.message.error_response:
-                    msg.respond(state.message.error_response)
-                else:
-                    invalid_msg = conf.INVALID_ANSWER_RESPONSE
-                    response = self._concat_answers(invalid_msg, state)
-                    msg.respond(response)
-
-                session.save()
+                return True
+
+            # update the number of times the user has tried
+            # to answer this.  If they have reached the
+            # maximum allowed then end their session and
+            # send them an error message.
+            num_tries = pointer.num_tries + 1
+            retries_exceeded = (state.num_retries is not None and
+                                num_tries >= state.num_retries)
+            next_state_id = None if retries_exceeded else pointer.state_id
+            if not self._update_session(pointer, next_state_id, num_tries):
+                # the session changed elsewhere, so start over
+                return self.handle(msg)
+            self._respond_invalid(msg, state, num_tries, retries_exceeded)
             return True
 
-        last_entry = Entry.objects.filter(session=session).order_by('sequence_id').last()
-        if last_entry:
-            sequence = last_entry.sequence_id + 1
-        else:
-            sequence = 1
-        entry = Entry.objects.create(session=session, sequence_id=sequence,
-                                     transition=found_transition,
-                                     text=msg.text)
-        logger.debug("entry %s saved", entry)
+        return self._accept_answer(msg, pointer, found_transition)
+
+    def handle_many(self, messages):
+        """Handles a burst of incoming messages, as ``handle`` would one by one.
+
+        Messages are grouped by connection, in the order each connection sent
+        them. The open sessions of every connection are loaded (and locked)
+        with a single query, and the entries, session updates and tag
+        notifications of the answers are written in bulk, in one transaction
+        for the whole batch. Messages which start or end a session are passed
+        to ``handle`` once the writes queued before them have been flushed.
+
+        Returns the result of each message, in the order they were given.
+        """
+        return self._handle_batch(messages)
+
+    def _handle_batch(self, messages, triggers=True):
+        """Handles messages with a MessageBatch; see handle_many.
 
-        # apply auto tags
-        entry.tags = entry.transition.tags.all()
-        # create tag notifications
-        TagNotification.create_from_entry(entry)
+        Without ``triggers``, the messages are only treated as answers.
+        """
+        messages = list(messages)
+        by_connection = OrderedDict()
+        for index, msg in enumerate(messages):
+            by_connection.setdefault(msg.connection.pk, []).append((index, msg))
+        results = [False] * len(messages)
+        with transaction.atomic():
+            batch = MessageBatch(self, [group[0][1].connection
+                                        for group in by_connection.values()])
+            for group in by_connection.values():
+                for index, msg in group:
+                    results[index] = batch.handle(msg, triggers)
+            batch.flush()
+        return results
+
+    def _respond_invalid(self, msg, state, num_tries, retries_exceeded):
+        """Responds to an answer that matched none of the state's transitions."""
+        if state.num_retries is not None:
+            if retries_exceeded:
+                msg.respond("Sorry, invalid answer %d times. "
+                            "Your session will now end. Please try again "
+                            "later." % num_tries)
+        # send them some hints about how to respond
+        elif state.error_response:
+            msg.respond(state.error_response)
+        else:
+            invalid_msg = conf.INVALID_ANSWER_RESPONSE
+            response = self._concat_answers(invalid_msg, state)
+            msg.respond(response)
+
+    def _accept_answer(self, msg, pointer, found_transition):
+        """Moves the session along an accepted transition and responds."""
+        # the entry is numbered from the session's counter, which is
+        # incremented along with the state change
+        sequence = pointer.entry_count + 1
+        pointer = self._update_session(pointer, found_transition.next_state_id, 0,
+                                       new_entries=1)
+        if not pointer:
+            # the session changed elsewhere, so start over
+            return self.handle(msg)
+
+        with transaction.atomic():
+            entry = Entry.objects.create(session_id=pointer.session_id,
+                                         tree_id=pointer.tree_id,
+                                         sequence_id=sequence,
+                                         transition_id=found_transition.id,
+                                         text=msg.text)
+            StateAnswerStats.add([(pointer.tree_id, found_transition.current_state_id,
+                                   found_transition.answer.id)])
+        logger.debug("entry %s saved", entry.pk)
+
+        # apply auto tags and create tag notifications
+        self._apply_tags([(entry.pk, found_transition)])
 
         # link message log to entry for tag relationship
         if hasattr(msg, 'logger_msg'):
             msg.logger_msg.entry = entry
             msg.logger_msg.save()
 
-        session.state = found_transition.next_state
-        session.num_tries = 0
-        session.save()
-
         '''
         If the next state does not have a transition set, then it is a terminal state.
         End the session. 
         '''
-        transition_set = Transition.objects.filter(current_state=session.state)
-        if not transition_set:
-            msg.respond(session.state.message.text)
+        next_state = compiled.get_state(pointer.tree_id, pointer.state_id)
+        if not next_state.transitions:
+            msg.respond(next_state.message_text)
 
-            self._end_session(session, message=msg)
+            self._end_session(Session.objects.get(pk=pointer.session_id), message=msg)
+            return True
 
         # if there is a next question ready to ask
         # send it along
-        self._send_message(session, msg)
+        self._send_message(pointer, msg)
         # if we haven't returned long before now, we're
         # long committed to dealing with this message
         return True
 
+    def _apply_tags(self, entries):
+        """Applies the auto tags of compiled transitions to new entries.
+
+        ``entries`` is a list of (entry id, compiled transition) pairs. Tags
+        and their recipients come from the compiled tree, so this costs at
+        most one insert for the tags and one for the notifications.
+        """
+        EntryTag = Entry.tags.through
+        EntryTag.objects.bulk_create([
+            EntryTag(entry_id=entry_id, tag_id=tag_id)
+            for entry_id, transition in entries
+            for tag_id in transition.tag_ids
+        ])
+        TagNotification.create_in_bulk(
+            (entry_id, tag_id, user_id)
+            for entry_id, transition in entries
+            for tag_id, user_id in transition.recipients
+        )
+
+    def _get_session(self, pointer):
+        """Loads the open Session a SessionPointer refers to.
+
+        Returns None, and discards the cached pointer, if that session is no
+        longer open.
+        """
+        sessions = Session.objects.open().filter(pk=pointer.session_id,
+                                                 state=pointer.state_id)
+        session = sessions.first()
+        if not session:
+            session_cache.clear_pointer(pointer.connection_id)
+        return session
+
+    def _update_session(self, pointer, state_id, num_tries, new_entries=0):
+        """Moves an open session to a new state (None closes it).
+
+        The update only applies if the session is still open, in the state
+        the pointer says it is in and with as many entries. Returns the new
+        pointer, or None if the session was changed elsewhere, in which case
+        the cached pointer is discarded. The new state's question is due
+        after its timeout.
+        """
+        now = self.scheduler.now()
+        timeout_at = self.scheduler.due_time(compiled.get_state(pointer.tree_id, state_id), now)
+        sessions = Session.objects.open().filter(pk=pointer.session_id,
+                                                 state=pointer.state_id,
+                                                 entry_count=pointer.entry_count)
+        updated = sessions.update(state=state_id, active=state_id is not None,
+                                  num_tries=num_tries,
+                                  entry_count=F('entry_count') + new_entries,
+                                  timeout_at=timeout_at, last_modified=now)
+        if not updated:
+            session_cache.clear_pointer(pointer.connection_id)
+            return None
+        new_pointer = pointer._replace(state_id=state_id, num_tries=num_tries,
+                                       entry_count=pointer.entry_count + new_entries)
+        if state_id is None:
+            session_cache.clear_pointer(pointer.connection_id)
+        else:
+            session_cache.set_pointer(new_pointer)
+        return new_pointer
+
 
     def tick(self, session):
         """
         Invoked periodically for each live session to check how long
         since we sent the last question, and decide to resend it or give
         up the whole thing.
+
+        Returns True if the session had timed out.
         """
         timeout = conf.TIMEOUT
-        idle_time = datetime.datetime.now() - session.last_modified
+        idle_time = timezone.now() - session.last_modified
         if idle_time >= datetime.timedelta(seconds=timeout):
-            # feed a dummy message to the handler
-            msg = IncomingMessage(connection=session.connection,
-                                  text="TimeOut")
-            self.router.incoming(msg)
-            msg.flush_responses()  # make sure response goes out
+            return self.timeout(session)
+        return False
+
+    def timeout(self, session):
+        """Tells the session that its current question has timed out."""
+        return self.timeout_many([session]) == 1
+
+    def timeout_many(self, sessions):
+        """Times out the current question of each session.
+
+        The "TimeOut" answer is applied to the connection's session directly,
+        without passing through the router, the other apps or the trigger
+        lookup, and with the session changes written in bulk as by
+        ``handle_many``. Responses are then sent in as few outgoing messages
+        as possible. Returns the number of sessions which timed out.
+        """
+        messages = [IncomingMessage(connections=[session.connection], text=TIMEOUT_TEXT)
+                    for session in sessions]
+        results = self._handle_batch(messages, triggers=False)
+        self._send_responses(messages)
+        return sum(1 for result in results if result)
+
+    def _send_responses(self, messages):
+        """Sends the responses to the messages, grouped by text.
+
+        Each connection's responses are sent in the order they were given,
+        i.e., the first response to every message is sent before any second
+        response.
+        """
+        responses = [msg.responses for msg in messages]
+        for position in range(max([len(r) for r in responses] or [0])):
+            connections = OrderedDict()
+            for response in responses:
+                if position < len(response):
+                    text = response[position]['text']
+                    connections.setdefault(text, []).extend(response[position]['connections'])
+            for text, recipients in connections.items():
+                logger.info("Sending: %s to %d connections", text, len(recipients))
+                send(text, recipients)
 
     def start_tree(self, tree, connection, msg=None):
         """Initiates a new tree sequence, terminating any active sessions"""
         self.end_sessions(connection)
+        root_state = compiled.get_state(tree.pk, tree.root_state_id)
         session = Session(connection=connection,
-                          tree=tree, state=tree.root_state, num_tries=0)
+                          tree=tree, state_id=tree.root_state_id, num_tries=0,
+                          timeout_at=self.scheduler.due_time(root_state))
         session.save()
+        session_cache.set_pointer(session_cache.pointer_for(session))
         logger.debug("new session %s saved", session)
 
         # also notify any session listeners of this
@@ -175,10 +341,14 @@ class App(AppBase):
         self._send_message(session, msg)
 
     def _send_message(self, session, msg=None):
-        """Sends the next message in the session, if there is one"""
-        state = session.state
-        if state and state.message:
-            response = self._concat_answers(state.message.text, state)
+        """Sends the next message in the session, if there is one.
+
+        The session may be a Session or a SessionPointer; the latter only
+        when a message to respond to is given.
+        """
+        state = compiled.get_state(session.tree_id, session.state_id)
+        if state:
+            response = self._concat_answers(state.message_text, state)
 
             logger.info("Sending: %s", response)
             if msg:
@@ -206,8 +376,9 @@ class App(AppBase):
            in the `close` function, and not doing so did not seem to have any bearing on the functionality of the code. """
         session.close(canceled)
 
-        if session.tree.trigger in self.session_listeners:
-            for func in self.session_listeners[session.tree.trigger]:
+        trigger = compiled.get_tree(session.tree_id).trigger
+        if trigger in self.session_listeners:
+            for func in self.session_listeners[trigger]:
                 func(session, True)
         session_end_signal.send(sender=self, session=session, canceled=canceled,
                                 message=message)
@@ -261,10 +432,189 @@ class App(AppBase):
         raise Exception("Don't know how to process answer type: %s", answer.type)
 
     def _concat_answers(self, response, state):
-        response += '\n'
-        transition_set = Transition.objects.filter(current_state=state).order_by('answer')
-        for t in transition_set:
-            response += t.answer.helper_text()
+        """Appends the answer hints of a compiled state to the response."""
+        return response + '\n' + state.hints
+
+
+class MessageBatch(object):
+    """Session changes made by App.handle_many, written in bulk.
+
+    Keeps the open sessions of the batch's connections as SessionPointers
+    (oldest first, so the last one is the session ``handle`` would pick) and
+    queues the session updates and entries of each answer until ``flush``.
+    """
+
+    def __init__(self, app, connections):
+        self.app = app
+        self.sessions = {}
+        self.updates = OrderedDict()
+        self.entries = []
+        self.load(connections)
+
+    def load(self, connections):
+        """(Re)loads the open sessions of the connections."""
+        for connection in connections:
+            self.sessions[connection.pk] = []
+        sessions = Session.objects.open().filter(connection__in=connections)
+        sessions = sessions.select_for_update().order_by('start_date', 'pk')
+        for session in sessions:
+            pointer = session_cache.pointer_for(session)
+            self.sessions[session.connection_id].append(pointer)
+
+    def pointer(self, connection):
+        sessions = self.sessions.get(connection.pk)
+        return sessions[-1] if sessions else None
+
+    def handle(self, msg, triggers=True):
+        """Handles a message as App.handle does, queueing its writes."""
+        if triggers and get_survey(msg.text, msg.connection):
+            return self.hand_over(msg)
+
+        pointer = self.pointer(msg.connection)
+        if not pointer:
+            logger.info('Tree not found: %s', msg.text)
+            return False
+        state = compiled.get_state(pointer.tree_id, pointer.state_id)
+        if state is None:
+            # the state was deleted since the session was loaded
+            return self.hand_over(msg)
+        logger.debug(state.name)
+
+        end_trigger = conf.SESSION_END_TRIGGER
+        if triggers and end_trigger is not None and msg.text == end_trigger:
+            return self.hand_over(msg)
+
+        functions = self.app.registered_functions
+        found_transition = state.matcher.match(msg.text, msg, functions)
+        if not found_transition:
+            if not state.transitions:
+                return self.hand_over(msg)
+            num_tries = pointer.num_tries + 1
+            retries_exceeded = (state.num_retries is not None and
+                                num_tries >= state.num_retries)
+            next_state_id = None if retries_exceeded else pointer.state_id
+            self.move(pointer, next_state_id, num_tries)
+            self.app._respond_invalid(msg, state, num_tries, retries_exceeded)
+            return True
 
-        return response
+        next_state = compiled.get_state(pointer.tree_id, found_transition.next_state_id)
+        if not next_state.transitions:
+            # ending the session can't be deferred; the session listeners
+            # and session_end_signal receivers expect it to be saved
+            self.flush()
+            self.sync_pointer(msg.connection)
+            result = self.app._accept_answer(msg, pointer, found_transition)
+            self.load([msg.connection])
+            return result
+
+        pointer = self.move(pointer, found_transition.next_state_id, 0, new_entries=1)
+        self.entries.append((pointer, found_transition, msg))
+        self.app._send_message(pointer, msg)
+        return True
 
+    def hand_over(self, msg):
+        """Passes a message to App.handle, after flushing the queued writes."""
+        self.flush()
+        self.sync_pointer(msg.connection)
+        result = self.app.handle(msg)
+        self.load([msg.connection])
+        return result
+
+    def sync_pointer(self, connection):
+        """Caches the session the batch holds for the connection."""
+        pointer = self.pointer(connection)
+        if pointer:
+            session_cache.set_pointer(pointer)
+        else:
+            session_cache.clear_pointer(connection.pk)
+
+    def move(self, pointer, state_id, num_tries, new_entries=0):
+        """Queues a session update; see App._update_session."""
+        sessions = self.sessions[pointer.connection_id]
+        sessions.remove(pointer)
+        pointer = pointer._replace(state_id=state_id, num_tries=num_tries,
+                                   entry_count=pointer.entry_count + new_entries)
+        if state_id is not None:
+            sessions.append(pointer)
+        state = compiled.get_state(pointer.tree_id, state_id)
+        self.updates[pointer.session_id] = (pointer, self.app.scheduler.due_time(state))
+        return pointer
+
+    def flush(self):
+        """Writes the queued session updates, entries and tags."""
+        if self.updates:
+            self._flush_updates()
+        if self.entries:
+            self._flush_entries()
+
+    def _flush_updates(self):
+        updates = list(self.updates.values())
+        pointers = [pointer for pointer, timeout_at in updates]
+        self.updates = OrderedDict()
+
+        def by_session(values, output_field):
+            whens = [When(pk=pointer.session_id, then=Value(value))
+                     for pointer, value in zip(pointers, values)]
+            return Case(*whens, output_field=output_field)
+
+        sessions = Session.objects.filter(pk__in=[p.session_id for p in pointers])
+        sessions.update(state=by_session([p.state_id for p in pointers], IntegerField()),
+                        active=by_session([p.state_id is not None for p in pointers],
+                                          BooleanField()),
+                        num_tries=by_session([p.num_tries for p in pointers], IntegerField()),
+                        entry_count=by_session([p.entry_count for p in pointers],
+                                               IntegerField()),
+                        timeout_at=by_session([t for p, t in updates], DateTimeField()),
+                        last_modified=self.app.scheduler.now())
+        connection_ids = set(pointer.connection_id for pointer in pointers)
+        current = [self.sessions[pk][-1] for pk in connection_ids if self.sessions[pk]]
+        session_cache.set_pointers(current)
+        for pk in connection_ids:
+            if not self.sessions[pk]:
+                session_cache.clear_pointer(pk)
+
+    def _flush_entries(self):
+        queued = self.entries
+        self.entries = []
+        entries = [
+            Entry(session_id=pointer.session_id, tree_id=pointer.tree_id,
+                  sequence_id=pointer.entry_count, transition_id=transition.id,
+                  text=msg.text)
+            for pointer, transition, msg in queued
+        ]
+        Entry.objects.bulk_create(entries)
+        StateAnswerStats.add((pointer.tree_id, transition.current_state_id, transition.answer.id)
+                             for pointer, transition, msg in queued)
+        if any(entry.pk is None for entry in entries):
+            # only some databases return the ids of bulk inserted rows
+            ids = Entry.objects.filter(session__in=set(e.session_id for e in entries))
+            ids = ids.order_by('pk').values_list('session_id', 'sequence_id', 'pk')
+            ids = dict(((session_id, sequence_id), pk) for session_id, sequence_id, pk in ids)
+            for entry in entries:
+                entry.pk = ids[(entry.session_id, entry.sequence_id)]
+        if multitenancy_enabled():
+            self._link_entries(entries)
+
+        # apply auto tags and create tag notifications
+        self.app._apply_tags([(entry.pk, transition)
+                              for entry, (pointer, transition, msg) in zip(entries, queued)])
+
+        # link message logs to entries for tag relationship
+        for entry, (pointer, transition, msg) in zip(entries, queued):
+            if hasattr(msg, 'logger_msg'):
+                msg.logger_msg.entry = entry
+                msg.logger_msg.save()
+
+    def _link_entries(self, entries):
+        """Links bulk created entries to the tenants of their sessions.
+
+        bulk_create doesn't send the post_save signal which would otherwise
+        create the links (see decisiontree.multitenancy.signals).
+        """
+        from .multitenancy.models import EntryLink, SessionLink
+        links = SessionLink.all_tenants.filter(linked__in=set(e.session_id for e in entries))
+        tenant_ids = dict(links.values_list('linked_id', 'tenant_id'))
+        EntryLink.all_tenants.bulk_create([
+            EntryLink(linked_id=entry.pk, tenant_id=tenant_ids.get(entry.session_id))
+            for entry in entries
+        ])
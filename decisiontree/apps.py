@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class DecisionTreeConfig(AppConfig):
+    name = "decisiontree"
+    verbose_name = "Decision Tree"
+
+    def ready(self):
+        # Import signals.
+        from . import signals  # noqa
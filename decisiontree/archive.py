@@ -0,0 +1,109 @@
+"""
+Archiving of closed sessions.
+
+Sessions and entries are otherwise kept forever, so the Session and Entry
+tables, and every query on them, would grow with the whole history of every
+survey. Sessions which closed more than DECISIONTREE_ARCHIVE_AFTER days ago
+are replaced by an ArchivedSession row each, which keeps the session's
+entries as JSON, so that the hot tables stay proportional to recent traffic.
+Survey exports include archived sessions on request.
+"""
+
+import datetime
+import json
+import logging
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import conf
+from .models import ArchivedSession, Entry, Session, TagNotification
+
+
+logger = logging.getLogger(__name__)
+
+
+def archivable(days, now=None):
+    """Returns the closed sessions which closed more than ``days`` days ago.
+
+    Sessions with tag notifications which haven't been emailed yet are kept
+    until they are.
+    """
+    if now is None:
+        now = timezone.now()
+    cutoff = now - datetime.timedelta(days=days)
+    sessions = Session.objects.closed().filter(
+        Q(last_modified__lt=cutoff) | Q(last_modified=None, start_date__lt=cutoff))
+    unsent = TagNotification.objects.filter(sent=False).values('entry__session')
+    return sessions.exclude(pk__in=unsent)
+
+
+def archive_sessions(days=None, chunk_size=None, now=None):
+    """Archives the sessions which closed more than ``days`` days ago.
+
+    ``days`` defaults to DECISIONTREE_ARCHIVE_AFTER; if neither is set,
+    nothing is archived. Sessions are archived in order of id,
+    ``chunk_size`` (by default DECISIONTREE_ARCHIVE_CHUNK_SIZE) at a time,
+    one transaction per chunk. Returns the number of sessions archived.
+    """
+    days = conf.ARCHIVE_AFTER if days is None else days
+    if days is None:
+        return 0
+    chunk_size = chunk_size or conf.ARCHIVE_CHUNK_SIZE
+    sessions = archivable(days, now).order_by('pk')
+    archived = 0
+    last = 0
+    while True:
+        with transaction.atomic():
+            chunk = list(sessions.filter(pk__gt=last)[:chunk_size])
+            if chunk:
+                last = chunk[-1].pk
+                archive(chunk)
+        archived += len(chunk)
+        if len(chunk) < chunk_size:
+            break
+    logger.info('archived %d sessions', archived)
+    return archived
+
+
+def archive(sessions):
+    """Replaces the sessions, their entries and tag links by ArchivedSessions.
+
+    Their tag notifications, which should all have been sent, are deleted.
+    """
+    ids = [session.pk for session in sessions]
+    tags = defaultdict(list)
+    entry_tags = Entry.tags.through.objects.filter(entry__session__in=ids)
+    for entry_id, name in entry_tags.values_list('entry_id', 'tag__name').order_by('tag__name'):
+        tags[entry_id].append(name)
+    entries = defaultdict(list)
+    queryset = Entry.objects.filter(session__in=ids).select_related('transition__answer')
+    for entry in queryset.order_by('sequence_id', 'pk'):
+        entries[entry.session_id].append({
+            'sequence_id': entry.sequence_id,
+            'time': entry.time.isoformat(),
+            'text': entry.text,
+            'transition_id': entry.transition_id,
+            'state_id': entry.transition.current_state_id,
+            'answer': entry.transition.answer.name,
+            'tags': tags[entry.pk],
+        })
+    ArchivedSession.objects.bulk_create([
+        ArchivedSession(
+            session_id=session.pk,
+            connection_id=session.connection_id,
+            tree_id=session.tree_id,
+            start_date=session.start_date,
+            last_modified=session.last_modified,
+            canceled=session.canceled,
+            entry_count=len(entries[session.pk]),
+            data=json.dumps({'entries': entries[session.pk]}, separators=(',', ':')),
+        )
+        for session in sessions
+    ])
+    TagNotification.objects.filter(entry__session__in=ids).delete()
+    entry_tags.delete()
+    Entry.objects.filter(session__in=ids).delete()
+    Session.objects.filter(pk__in=ids).delete()
@@ -0,0 +1,350 @@
+"""
+Immutable, in-memory representations of decision trees.
+
+Answering a question only needs the structure of a tree (its states,
+transitions, answers and prompts), and recognizing a trigger only needs the
+list of survey keywords. Both change far less often than they are read.
+
+The structure of each tree is saved as a JSON snapshot in Tree.compiled, built
+on first use after the tree or any of its components change; every change
+also increments Tree.version. Each worker keeps the trees it has compiled from
+their snapshots and, when told through Django's cache framework that
+something was edited (e.g., in the web admin), only checks their versions.
+"""
+
+import json
+import logging
+import threading
+from collections import defaultdict, namedtuple
+from uuid import uuid4
+
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F
+
+from . import conf
+from .matchers import StateMatcher
+from .models import Session, Tag, Transition, Tree, TreeState, depth_first
+
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = 'decisiontree:compiled-generation'
+
+
+CompiledAnswer = namedtuple('CompiledAnswer', [
+    'id', 'name', 'type', 'answer', 'helper_text',
+])
+
+CompiledTransition = namedtuple('CompiledTransition', [
+    'id', 'current_state_id', 'answer', 'next_state_id', 'tag_ids',
+    'recipients',
+])
+
+CompiledState = namedtuple('CompiledState', [
+    'id', 'name', 'num_retries', 'timeout', 'message_text', 'error_response',
+    'transitions', 'hints', 'matcher',
+])
+
+CompiledTree = namedtuple('CompiledTree', [
+    'id', 'trigger', 'root_state_id', 'states', 'order', 'version',
+])
+
+
+def build_snapshot(tree_id, extra_state_ids=()):
+    """Describe a tree's structure with JSON-serializable values.
+
+    The snapshot contains every state reachable from the root state, plus any
+    state reachable from ``extra_state_ids``, and lists the states reachable
+    from the root in depth first order. Transitions are loaded one level at a
+    time, so the number of queries is bounded by the depth of the tree rather
+    than by the number of states.
+    """
+    tree = Tree.objects.values('pk', 'trigger', 'root_state_id').get(pk=tree_id)
+    seen = set([tree['root_state_id']])
+    seen.update(extra_state_ids)
+    queryset = Transition.objects.select_related('answer').order_by('pk')
+    transitions = TreeState.reachable_transitions(seen, queryset)
+    seen.update(t.next_state_id for ts in transitions.values() for t in ts)
+
+    transition_ids = [t.pk for ts in transitions.values() for t in ts]
+    tag_ids = defaultdict(list)
+    through = Transition.tags.through.objects.filter(transition__in=transition_ids)
+    for transition_id, tag_id in through.values_list('transition_id', 'tag_id'):
+        tag_ids[transition_id].append(tag_id)
+    recipients = defaultdict(list)
+    all_tag_ids = set(tag_id for ids in tag_ids.values() for tag_id in ids)
+    through = Tag.recipients.through.objects.filter(tag__in=all_tag_ids)
+    for tag_id, user_id in through.values_list('tag_id', 'user_id'):
+        recipients[tag_id].append(user_id)
+
+    states = []
+    queryset = TreeState.objects.filter(pk__in=seen).select_related('message')
+    for state in queryset.order_by('pk'):
+        states.append({
+            'id': state.pk,
+            'name': state.name,
+            'num_retries': state.num_retries,
+            'timeout': state.timeout,
+            'message_text': state.message.text,
+            'error_response': state.message.error_response,
+            'transitions': [{
+                'id': transition.pk,
+                'answer': {
+                    'id': transition.answer.pk,
+                    'name': transition.answer.name,
+                    'type': transition.answer.type,
+                    'answer': transition.answer.answer,
+                    'helper_text': transition.answer.helper_text(),
+                },
+                'next_state_id': transition.next_state_id,
+                'tag_ids': sorted(tag_ids[transition.pk]),
+                'recipients': [
+                    [tag_id, user_id]
+                    for tag_id in sorted(tag_ids[transition.pk])
+                    for user_id in sorted(recipients[tag_id])
+                ],
+            } for transition in transitions[state.pk]],
+        })
+    return {
+        'id': tree['pk'],
+        'trigger': tree['trigger'],
+        'root_state_id': tree['root_state_id'],
+        'order': list(depth_first(transitions, tree['root_state_id'])),
+        'states': states,
+    }
+
+
+def load_snapshot(snapshot, version=None):
+    """Build a CompiledTree from a snapshot."""
+    states = {}
+    for state in snapshot['states']:
+        compiled_transitions = tuple(
+            CompiledTransition(
+                id=transition['id'],
+                current_state_id=state['id'],
+                answer=CompiledAnswer(**transition['answer']),
+                next_state_id=transition['next_state_id'],
+                tag_ids=tuple(transition['tag_ids']),
+                recipients=tuple(tuple(pair) for pair in transition['recipients']),
+            )
+            for transition in state['transitions']
+        )
+        # Hints are listed in answer order, as they were when they were
+        # generated from the Transition table on every message.
+        by_answer = sorted(compiled_transitions, key=lambda t: t.answer.id)
+        states[state['id']] = CompiledState(
+            id=state['id'],
+            name=state['name'],
+            num_retries=state['num_retries'],
+            timeout=state['timeout'],
+            message_text=state['message_text'],
+            error_response=state['error_response'],
+            transitions=compiled_transitions,
+            hints=u''.join(t.answer.helper_text for t in by_answer),
+            matcher=StateMatcher(compiled_transitions),
+        )
+    return CompiledTree(
+        id=snapshot['id'],
+        trigger=snapshot['trigger'],
+        root_state_id=snapshot['root_state_id'],
+        states=states,
+        order=tuple(snapshot['order']),
+        version=version,
+    )
+
+
+def compile_tree(tree_id, extra_state_ids=(), version=None):
+    """Build a CompiledTree from the database."""
+    tree = load_snapshot(build_snapshot(tree_id, extra_state_ids), version)
+    logger.debug("compiled tree %s with %d states", tree_id, len(tree.states))
+    return tree
+
+
+def get_snapshot(tree_id):
+    """Return the version and snapshot of a tree.
+
+    The snapshot is read from the tree's row or, if the tree changed since it
+    was last built, built and saved.
+    """
+    version, data = Tree.objects.values_list('version', 'compiled').get(pk=tree_id)
+    if data:
+        return version, json.loads(data)
+    snapshot = build_snapshot(tree_id)
+    data = json.dumps(snapshot, separators=(',', ':'))
+    # Not saved if the tree changed again in the meantime.
+    Tree.objects.filter(pk=tree_id, version=version).update(compiled=data)
+    return version, snapshot
+
+
+def mark_changed(tree_ids=None):
+    """Discard the snapshots of the trees (by default, of every tree)."""
+    trees = Tree.objects.all()
+    if tree_ids is not None:
+        trees = trees.filter(pk__in=tree_ids)
+    trees.update(compiled='', version=F('version') + 1)
+
+
+def find_tree_ids(state_ids):
+    """Return the ids of the trees whose compiled form may include the states.
+
+    Those are the trees whose root state reaches any of the states, found by
+    following transitions backwards a level at a time, plus the trees of
+    sessions in those states (see TreeRegistry.get_state).
+    """
+    seen = set(state_ids)
+    frontier = set(seen)
+    while frontier:
+        parents = Transition.objects.filter(next_state__in=frontier)
+        frontier = set(parents.values_list('current_state_id', flat=True)) - seen
+        seen.update(frontier)
+    if not seen:
+        return []
+    tree_ids = set(Tree.objects.filter(root_state__in=seen).values_list('pk', flat=True))
+    sessions = Session.objects.filter(state__in=seen).order_by()
+    tree_ids.update(sessions.values_list('tree_id', flat=True).distinct())
+    return sorted(tree_ids)
+
+
+def build_trigger_index(multitenancy=False):
+    """Map (tenant id, lowercased trigger) to the id of the matching tree.
+
+    Without multitenancy the tenant id is always None. When several triggers
+    are equal ignoring case, the tree with the lowest id wins, as it did with
+    ``trigger__iexact`` lookups.
+    """
+    fields = ['pk', 'trigger']
+    if multitenancy:
+        fields.append('tenantlink__tenant')
+    index = {}
+    for row in Tree.objects.order_by('-pk').values_list(*fields):
+        tenant_id = row[2] if multitenancy else None
+        index[(tenant_id, row[1].lower())] = row[0]
+    return index
+
+
+def build_backend_index():
+    """Map backend ids to tenant ids."""
+    from multitenancy.models import BackendLink
+    return dict(BackendLink.all_tenants.values_list('backend_id', 'tenant_id'))
+
+
+class TreeRegistry(object):
+    """Per-process store of compiled trees and trigger indexes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = None
+        self._trees = {}
+        self._checked = set()
+        self._indexes = {}
+
+    @property
+    def cache(self):
+        return caches[conf.CACHE_ALIAS]
+
+    def _current_generation(self):
+        """Return the generation, and whether it had been lost from the cache."""
+        generation = self.cache.get(GENERATION_KEY)
+        if generation is None:
+            self.cache.add(GENERATION_KEY, uuid4().hex, None)
+            return self.cache.get(GENERATION_KEY), True
+        return generation, False
+
+    def _refresh(self):
+        generation, lost = self._current_generation()
+        with self._lock:
+            if lost:
+                # There's no telling what changed while it was gone.
+                self._trees = {}
+            if generation != self._generation:
+                # Compiled trees are kept until their versions are checked.
+                self._checked = set()
+                self._indexes = {}
+                self._generation = generation
+
+    def _fresh_index(self, name, build):
+        self._refresh()
+        index = self._indexes.get(name)
+        if index is None:
+            index = build()
+            self._indexes[name] = index
+        return index
+
+    def get_tree(self, tree_id):
+        self._refresh()
+        tree = self._trees.get(tree_id)
+        if tree is not None and tree_id in self._checked:
+            return tree
+        if tree is not None:
+            version = Tree.objects.values_list('version', flat=True).get(pk=tree_id)
+            if version != tree.version:
+                tree = None
+        if tree is None:
+            version, snapshot = get_snapshot(tree_id)
+            tree = load_snapshot(snapshot, version)
+            self._trees[tree_id] = tree
+        self._checked.add(tree_id)
+        return tree
+
+    def get_state(self, tree_id, state_id):
+        """Return the compiled state, or None if the state does not exist."""
+        if state_id is None:
+            return None
+        tree = self.get_tree(tree_id)
+        state = tree.states.get(state_id)
+        if state is None:
+            # The state is no longer reachable from the root (e.g., the tree
+            # was edited mid-session). Compile it alongside the tree.
+            tree = compile_tree(tree_id, extra_state_ids=[state_id], version=tree.version)
+            self._trees[tree_id] = tree
+            state = tree.states.get(state_id)
+        return state
+
+    def find_tree_id(self, trigger, tenant_id=None, multitenancy=False):
+        """Return the id of the tree triggered by the text, or None."""
+        name = 'triggers-tenant' if multitenancy else 'triggers'
+        index = self._fresh_index(name, lambda: build_trigger_index(multitenancy))
+        return index.get((tenant_id, trigger.lower()))
+
+    def get_backend_tenant_id(self, backend_id):
+        """Return the id of the tenant which owns the backend, or None."""
+        return self._fresh_index('backends', build_backend_index).get(backend_id)
+
+    def invalidate(self, tree_ids=None):
+        """Mark trees (by default, all of them) as changed.
+
+        Their snapshots are rebuilt on next use, and every process checks the
+        versions of the trees it has compiled.
+        """
+        mark_changed(tree_ids)
+        self.reindex()
+
+    def reindex(self):
+        """Rebuild the trigger and backend indexes in every process.
+
+        Compiled trees are kept, as tenant assignments are not part of them.
+        """
+        # Notice if the generation was lost before replacing it.
+        self._refresh()
+        self._new_generation()
+        # Other processes may have checked versions before the change was
+        # committed, so tell them again once it is.
+        transaction.on_commit(self._new_generation)
+
+    def _new_generation(self):
+        self.cache.set(GENERATION_KEY, uuid4().hex, None)
+        with self._lock:
+            self._checked = set()
+            self._indexes = {}
+            self._generation = None
+
+
+registry = TreeRegistry()
+
+get_tree = registry.get_tree
+get_state = registry.get_state
+find_tree_id = registry.find_tree_id
+get_backend_tenant_id = registry.get_backend_tenant_id
+invalidate = registry.invalidate
+reindex = registry.reindex
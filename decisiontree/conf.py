@@ -4,6 +4,30 @@ INVALID_ANSWER_RESPONSE = getattr(settings, 'INVALID_ANSWER_RESPONSE', 'Not a va
 
 NOTIFICATIONS_ENABLED = getattr(settings, 'DECISIONTREE_NOTIFICATIONS', False)
 
+DIGEST_WORKERS = getattr(settings, 'DECISIONTREE_DIGEST_WORKERS', 1)
+
 SESSION_END_TRIGGER = getattr(settings, 'DECISIONTREE_SESSION_END_TRIGGER', 'end')
 
 TIMEOUT = getattr(settings, 'DECISIONTREE_TIMEOUT', 300)
+
+TIMEOUT_CHUNK_SIZE = getattr(settings, 'DECISIONTREE_TIMEOUT_CHUNK_SIZE', 500)
+
+TASK_LOCK_TIMEOUT = getattr(settings, 'DECISIONTREE_TASK_LOCK_TIMEOUT', 30 * 60)
+
+CACHE_ALIAS = getattr(settings, 'DECISIONTREE_CACHE', 'default')
+
+SESSION_CACHE_TIMEOUT = getattr(settings, 'DECISIONTREE_SESSION_CACHE_TIMEOUT', 24 * 60 * 60)
+
+SESSION_CACHE_MISS_TIMEOUT = getattr(settings, 'DECISIONTREE_SESSION_CACHE_MISS_TIMEOUT', 60)
+
+ARCHIVE_AFTER = getattr(settings, 'DECISIONTREE_ARCHIVE_AFTER', None)
+
+ARCHIVE_CHUNK_SIZE = getattr(settings, 'DECISIONTREE_ARCHIVE_CHUNK_SIZE', 500)
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'DECISIONTREE_EXPORT_CHUNK_SIZE', 1000)
+
+EXPORT_JOB_TIMEOUT = getattr(settings, 'DECISIONTREE_EXPORT_JOB_TIMEOUT', 30 * 60)
+
+EXPORT_CURSOR_LAG = getattr(settings, 'DECISIONTREE_EXPORT_CURSOR_LAG', 60)
+
+REPORT_PAGE_SIZE = getattr(settings, 'DECISIONTREE_REPORT_PAGE_SIZE', 100)
@@ -0,0 +1,389 @@
+"""
+Survey exports.
+
+A survey export has a row per session, with the caller, the start date and
+the answer given to each state of the survey. Sessions are loaded
+DECISIONTREE_EXPORT_CHUNK_SIZE at a time, with the answers of each chunk
+loaded by a single query, and rows are produced as they are needed, so that
+exporting a survey takes the same memory however many sessions it has.
+
+Large exports can also be written to file storage by a background task
+(an ExportJob), whose progress can be polled. Each job records a key for the
+survey data it exported, so a finished export is downloaded again, rather
+than written again, until the survey or its sessions change.
+
+Exports also come with a cursor: the time their survey's sessions were last
+modified, held back by DECISIONTREE_EXPORT_CURSOR_LAG seconds. A delta export
+from a cursor only has the sessions which were answered or closed since, so
+that a regular export costs as much as the new data rather than the whole
+history of the survey.
+
+Surveys can also be exported as Parquet files, with typed columns, if pyarrow
+is installed. They are written a chunk of sessions (a row group) at a time.
+"""
+
+import csv
+import datetime
+import hashlib
+import io
+import logging
+import tempfile
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import conf
+from .models import Entry, ExportJob, Session
+
+
+logger = logging.getLogger(__name__)
+
+
+class Echo(object):
+    """A file-like object which returns what is written to it."""
+
+    def write(self, value):
+        return value
+
+
+def chunked(queryset, key, chunk_size):
+    """Yields lists of the queryset's objects, paged by the unique ``key``."""
+    last = None
+    while True:
+        chunk = queryset
+        if last is not None:
+            chunk = chunk.filter(**{key + '__gt': last})
+        chunk = list(chunk.order_by(key)[:chunk_size])
+        if chunk:
+            last = getattr(chunk[-1], key)
+            yield chunk
+        if len(chunk) < chunk_size:
+            break
+
+
+def survey_headings(states):
+    return ["Person", "Date"] + [state.message for state in states]
+
+
+def session_chunks(tree, chunk_size=None, since=None, until=None):
+    """Yields the tree's sessions, in order of id, a chunk at a time.
+
+    Each chunk comes with the answers of its sessions, as a dictionary of
+    session id to a dictionary of state id to the answer's name and the text
+    of the message which gave it. Only sessions last modified (e.g.,
+    answered or closed) after ``since`` and no later than ``until`` are
+    loaded, if given.
+    """
+    chunk_size = chunk_size or conf.EXPORT_CHUNK_SIZE
+    sessions = Session.objects.filter(tree=tree).select_related('connection__backend')
+    if since is not None:
+        sessions = sessions.filter(last_modified__gt=since)
+    if until is not None:
+        sessions = sessions.filter(last_modified__lte=until)
+    for chunk in chunked(sessions, 'pk', chunk_size):
+        answers = defaultdict(dict)
+        entries = Entry.objects.filter(session__in=[session.pk for session in chunk])
+        entries = entries.order_by('session', 'sequence_id', 'pk').values_list(
+            'session_id', 'transition__current_state_id', 'transition__answer__name', 'text')
+        for session_id, state_id, answer, text in entries:
+            # the latest answer to a state wins
+            answers[session_id][state_id] = (answer, text)
+        yield chunk, answers
+
+
+def archived_chunks(tree, chunk_size=None):
+    """Yields the tree's archived sessions like session_chunks."""
+    chunk_size = chunk_size or conf.EXPORT_CHUNK_SIZE
+    sessions = tree.archived_sessions.select_related('connection__backend')
+    for chunk in chunked(sessions, 'session_id', chunk_size):
+        answers = {}
+        for session in chunk:
+            answers[session.session_id] = dict(
+                (entry['state_id'], (entry['answer'], entry['text']))
+                for entry in session.get_entries())
+        yield chunk, answers
+
+
+def session_rows(tree, states, chunk_size=None, since=None, until=None):
+    """Yields the export row of each of the tree's sessions, in order of id."""
+    for chunk, answers in session_chunks(tree, chunk_size, since, until):
+        for session in chunk:
+            values = [str(session.connection), session.start_date]
+            values.extend(answers[session.pk].get(state.pk, ("",))[0] for state in states)
+            yield values
+
+
+def archived_rows(tree, states, chunk_size=None):
+    """Yields the export row of each of the tree's archived sessions."""
+    for chunk, answers in archived_chunks(tree, chunk_size):
+        for session in chunk:
+            values = [str(session.connection), session.start_date]
+            values.extend(answers[session.session_id].get(state.pk, ("",))[0]
+                          for state in states)
+            yield values
+
+
+def survey_rows(tree, states, archived=False, chunk_size=None, since=None, until=None):
+    """Yields the headings and rows of a survey export.
+
+    Archived sessions, which are older than the others, come first if
+    ``archived`` is True. A delta export, i.e., one with a ``since`` cursor,
+    only has the sessions modified after it and up to ``until``; archived
+    sessions are left out, as they were exported before they were archived.
+    """
+    yield survey_headings(states)
+    if archived and since is None:
+        for row in archived_rows(tree, states, chunk_size):
+            yield row
+    for row in session_rows(tree, states, chunk_size, since, until):
+        yield row
+
+
+def get_cursor(tree, since=None):
+    """Returns the cursor a delta export of the survey would run up to now.
+
+    That is the time its sessions were last modified, but no later than
+    DECISIONTREE_EXPORT_CURSOR_LAG seconds ago, or ``since`` if none were
+    modified after it. Exporting the sessions modified after ``since`` and up
+    to the cursor, then after the cursor the next time, and so on, exports
+    each change once.
+
+    The lag is there because a session's modification time is set before
+    its transaction commits, so a session may still turn up with a time
+    before a cursor taken moments earlier. Changes within the lag are left
+    for the next export instead.
+    """
+    last = tree.sessions.aggregate(last=Max('last_modified'))['last']
+    if last is None:
+        return since
+    lagged = timezone.now() - datetime.timedelta(seconds=conf.EXPORT_CURSOR_LAG)
+    cursor = min(last, lagged)
+    if since is not None and cursor < since:
+        return since
+    return cursor
+
+
+def format_cursor(cursor):
+    return cursor.isoformat() if cursor is not None else ''
+
+
+def parse_cursor(value):
+    """Parses a cursor returned by format_cursor; raises ValueError if invalid."""
+    cursor = parse_datetime(value)
+    if cursor is None:
+        raise ValueError("Invalid cursor: %r" % value)
+    return cursor
+
+
+def csv_lines(rows):
+    """Yields the rows as lines of CSV."""
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def _record(session_id, identity, start, end, answers, states):
+    values = [session_id, identity, start, end]
+    for state in states:
+        values.extend(answers.get(state.pk, (None, None)))
+    return tuple(values)
+
+
+def session_records(tree, states, archived=False, chunk_size=None, since=None, until=None):
+    """Yields lists of typed export records, a chunk of sessions at a time.
+
+    A record has the session's id, the identity of its connection, its start
+    date and its end date (None while it is open), then the name of the
+    answer and the text of the message given to each state (None if it was
+    not answered). Sessions are selected as by survey_rows.
+    """
+    if archived and since is None:
+        for chunk, answers in archived_chunks(tree, chunk_size):
+            yield [_record(session.session_id, session.connection.identity,
+                           session.start_date, session.last_modified,
+                           answers[session.session_id], states)
+                   for session in chunk]
+    for chunk, answers in session_chunks(tree, chunk_size, since, until):
+        yield [_record(session.pk, session.connection.identity, session.start_date,
+                       None if session.is_open() else session.last_modified,
+                       answers[session.pk], states)
+               for session in chunk]
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImproperlyConfigured("Parquet exports require pyarrow.")
+    return pyarrow
+
+
+def columnar_schema(states):
+    """Returns the Arrow schema of session_records.
+
+    The columns of each state are named after its id, as names and questions
+    need not be unique, and carry them as metadata.
+    """
+    pa = _import_pyarrow()
+    timestamp = pa.timestamp('us', tz='UTC' if settings.USE_TZ else None)
+    fields = [
+        pa.field('session_id', pa.int64(), nullable=False),
+        pa.field('connection', pa.string(), nullable=False),
+        pa.field('start_date', timestamp, nullable=False),
+        pa.field('end_date', timestamp),
+    ]
+    for state in states:
+        metadata = {'state': state.name, 'question': state.message.text}
+        fields.append(pa.field('answer_%d' % state.pk, pa.string(), metadata=metadata))
+        fields.append(pa.field('text_%d' % state.pk, pa.string(), metadata=metadata))
+    return pa.schema(fields)
+
+
+def record_batches(schema, records):
+    """Yields a RecordBatch for each list of records."""
+    pa = _import_pyarrow()
+    for chunk in records:
+        columns = zip(*chunk)
+        yield pa.RecordBatch.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+            schema=schema)
+
+
+class Sink(io.RawIOBase):
+    """A write-only file which hands over what was written to it on demand."""
+
+    def __init__(self):
+        super(Sink, self).__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def parquet_chunks(tree, states, archived=False, chunk_size=None, since=None, until=None):
+    """Returns an iterator of the bytes of a Parquet file of session_records.
+
+    Each chunk of sessions is converted to a record batch and written as a
+    row group, so only a chunk is ever held in memory.
+    """
+    pa = _import_pyarrow()
+    schema = columnar_schema(states)
+    records = session_records(tree, states, archived, chunk_size, since, until)
+    return _write_parquet(pa, schema, record_batches(schema, records))
+
+
+def _write_parquet(pa, schema, batches):
+    output = Sink()
+    writer = pa.parquet.ParquetWriter(output, schema)
+    for batch in batches:
+        writer.write_table(pa.Table.from_batches([batch], schema=schema))
+        yield output.drain()
+    writer.close()
+    yield output.drain()
+
+
+def export_key(tree, archived=False):
+    """Returns a key which changes whenever the survey's export would.
+
+    It depends on the survey's version (i.e., on any change to the survey's
+    structure), on the time of its latest entry, on its latest and last
+    modified sessions and their number (so closing, timing out or deleting
+    sessions changes it), and on when its sessions were last archived and
+    how many there are.
+    """
+    sessions = tree.sessions.aggregate(
+        last=Max('pk'), modified=Max('last_modified'), count=Count('pk'))
+    archived_sessions = tree.archived_sessions.aggregate(
+        last=Max('archived'), count=Count('pk'))
+    parts = [
+        tree.pk,
+        tree.version,
+        tree.entries.aggregate(last=Max('time'))['last'],
+        sessions['last'],
+        sessions['modified'],
+        sessions['count'],
+        archived_sessions['last'],
+        archived_sessions['count'],
+        archived,
+    ]
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def get_or_create_job(tree, archived=False):
+    """Returns an export job for the survey, and whether it was created.
+
+    A job is reused if it exported the survey's current data, or is still
+    exporting it. Pending or running jobs which made no progress for
+    DECISIONTREE_EXPORT_JOB_TIMEOUT seconds, e.g., because their worker died,
+    are marked as failed instead. New jobs must be started with
+    decisiontree.tasks.export_survey.
+    """
+    stale = timezone.now() - datetime.timedelta(seconds=conf.EXPORT_JOB_TIMEOUT)
+    tree.export_jobs.filter(
+        status__in=[ExportJob.PENDING, ExportJob.RUNNING], updated__lt=stale,
+    ).update(status=ExportJob.FAILED)
+    key = export_key(tree, archived)
+    jobs = tree.export_jobs.filter(key=key).exclude(status=ExportJob.FAILED)
+    for job in jobs.order_by('-pk'):
+        if job.status != ExportJob.DONE or job.is_available():
+            return job, False
+    return ExportJob.objects.create(tree=tree, key=key, archived=archived), True
+
+
+def run_job(job_id, chunk_size=None):
+    """Writes the export of a job to file storage, recording its progress.
+
+    The number of sessions written is saved every ``chunk_size`` (by default
+    DECISIONTREE_EXPORT_CHUNK_SIZE) sessions, along with the time, so that
+    get_or_create_job can tell a stalled job from a slow one.
+    """
+    chunk_size = chunk_size or conf.EXPORT_CHUNK_SIZE
+    job = ExportJob.objects.select_related('tree').get(pk=job_id)
+    jobs = ExportJob.objects.filter(pk=job.pk)
+    tree = job.tree
+    total = tree.sessions.count()
+    if job.archived:
+        total += tree.archived_sessions.count()
+    jobs.update(status=ExportJob.RUNNING, total=total, updated=timezone.now())
+    try:
+        states = tree.get_all_states()
+        rows = 0
+        with tempfile.TemporaryFile('w+', newline='') as output:
+            writer = csv.writer(output)
+            sessions = survey_rows(tree, states, job.archived, chunk_size)
+            writer.writerow(next(sessions))  # the headings
+            for row in sessions:
+                writer.writerow(row)
+                rows += 1
+                if rows % chunk_size == 0:
+                    jobs.update(rows=rows, updated=timezone.now())
+            output.seek(0)
+            job.file.save('%s.csv' % tree.trigger, File(output), save=False)
+    except Exception:
+        jobs.update(status=ExportJob.FAILED, updated=timezone.now())
+        raise
+    now = timezone.now()
+    jobs.update(status=ExportJob.DONE, rows=rows, file=job.file.name,
+                updated=now, finished=now)
+    logger.info('exported %d sessions of %s to %s', rows, tree.trigger, job.file.name)
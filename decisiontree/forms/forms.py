@@ -36,7 +36,7 @@ class AnswerSearchForm(forms.Form):
         tree = kwargs.pop('tree')
         super(AnswerSearchForm, self).__init__(*args, **kwargs)
         # answers = models.Answer.objects.filter(transitions__entries__session__tree=tree)
-        tags = models.Tag.objects.filter(entries__session__tree=tree).distinct()
+        tags = models.Tag.objects.filter(entries__tree=tree).distinct()
 
         # self.fields['answer'].queryset = answers.distinct()
         self.fields['tag'].queryset = tags
@@ -108,7 +108,7 @@ class StateCreateUpdateForm(TenancyModelForm):
 
     class Meta:
         model = models.TreeState
-        fields = ['name', 'message', 'num_retries']
+        fields = ['name', 'message', 'num_retries', 'timeout']
 
 
 class SurveyCreateUpdateForm(TenancyModelForm):
@@ -1,5 +1,8 @@
+from collections import OrderedDict
+
 from rapidsms.contrib.handlers.handlers.keyword import KeywordHandler
 
+from decisiontree.models import StateAnswerStats
 from decisiontree.utils import get_survey
 
 
@@ -10,12 +13,26 @@ class ResultsHandler(KeywordHandler):
         self.respond("Please enter a survey keyword")
 
     def handle(self, text):
-        """Send the summary of the survey, if one exists."""
+        """Send the summary of the survey or, without one, its answer counts."""
         survey = get_survey(text, self.msg.connection)
         if not survey:
             self.respond('Survey "{0}" does not exist'.format(text))
         elif survey.summary:
             self.respond(survey.summary)
         else:
-            self.respond('No summary for "{0}" survey'.format(text))
+            results = self.results(survey)
+            if results:
+                self.respond('Results for "{0}": {1}'.format(text, results))
+            else:
+                self.respond('No summary for "{0}" survey'.format(text))
         return True
+
+    def results(self, survey):
+        """The number of times each answer was given, by state."""
+        stats = StateAnswerStats.objects.filter(tree=survey).exclude(count=0)
+        stats = stats.values_list('state__name', 'answer__name', 'count')
+        by_state = OrderedDict()
+        for state, answer, count in stats.order_by('state', 'answer__name'):
+            by_state.setdefault(state, []).append('{0} {1}'.format(answer, count))
+        return '; '.join('{0}: {1}'.format(state, ', '.join(answers))
+                         for state, answers in by_state.items())
@@ -0,0 +1,87 @@
+"""
+Run-exclusivity for periodic tasks.
+
+A periodic task which takes longer than its beat interval would otherwise be
+started again while it is still running, and both copies would time out the
+same sessions or email the same notifications. Each run takes a lease in the
+DECISIONTREE_CACHE cache, which expires after DECISIONTREE_TASK_LOCK_TIMEOUT
+seconds in case the worker holding it dies; runs which find the lease taken
+are skipped and counted.
+"""
+
+import functools
+import logging
+from uuid import uuid4
+
+from django.core.cache import caches
+
+from . import conf
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_cache():
+    return caches[conf.CACHE_ALIAS]
+
+
+def lock_key(name):
+    return 'decisiontree:lock:%s' % name
+
+
+def skipped_key(name):
+    return 'decisiontree:lock:%s:skipped' % name
+
+
+def acquire(name, timeout=None):
+    """Takes the lease; returns its token, or None if it is already taken."""
+    token = uuid4().hex
+    timeout = conf.TASK_LOCK_TIMEOUT if timeout is None else timeout
+    if get_cache().add(lock_key(name), token, timeout):
+        return token
+    return None
+
+
+def release(name, token):
+    """Gives up the lease, unless it expired and was taken by another run."""
+    if get_cache().get(lock_key(name)) == token:
+        get_cache().delete(lock_key(name))
+
+
+def skipped_runs(name):
+    """Returns how many runs were skipped because the lease was taken."""
+    return get_cache().get(skipped_key(name), 0)
+
+
+def _count_skipped(name):
+    key = skipped_key(name)
+    get_cache().add(key, 0, None)
+    try:
+        return get_cache().incr(key)
+    except ValueError:
+        # the counter was evicted in between
+        get_cache().set(key, 1, None)
+        return 1
+
+
+def exclusive(name, timeout=None):
+    """Decorates a function so that only one call runs at a time.
+
+    Calls made while another is running return None without calling the
+    function.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = acquire(name, timeout)
+            if token is None:
+                count = _count_skipped(name)
+                logger.warning('%s is still running; skipped this run '
+                               '(%d skipped so far)', name, count)
+                return None
+            try:
+                return func(*args, **kwargs)
+            finally:
+                release(name, token)
+        return wrapper
+    return decorator
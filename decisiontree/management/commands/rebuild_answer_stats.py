@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from decisiontree.models import StateAnswerStats
+
+
+class Command(BaseCommand):
+    help = "Recounts the answers of surveys from their entries and archived sessions."
+
+    def add_arguments(self, parser):
+        parser.add_argument('tree_ids', nargs='*', type=int, metavar='tree_id',
+                            help="The surveys to recount (by default, every survey).")
+
+    def handle(self, *args, **options):
+        count = StateAnswerStats.rebuild(options['tree_ids'] or None)
+        self.stdout.write("Counted %d answers." % count)
@@ -0,0 +1,104 @@
+"""
+Answer matching for compiled tree states.
+
+A state's transitions are tried in order and the first one whose answer
+matches the message wins. Rather than testing every answer in turn, a
+StateMatcher groups them by type:
+
+* exact ('A') answers are looked up in a dict keyed by lowercased text,
+* regular expression ('R') answers are joined into a single alternation with
+  one named group per transition, and
+* custom ('C') answers are called last, and only when they come before the
+  best static match, so that registered functions run no more often than
+  they did when every transition was tried in order.
+"""
+
+import re
+
+
+# Patterns that can't be wrapped in a named group of a larger expression:
+# numbered or named backreferences, named groups (which may clash between
+# patterns) and global inline flags.
+UNCOMBINABLE = re.compile(r'\\\d|\(\?P[<=]|^\(\?[aiLmsux]')
+
+
+class StateMatcher(object):
+    """Finds the first transition of a state that matches a message."""
+
+    def __init__(self, transitions):
+        self.transitions = tuple(transitions)
+        self.exact = {}
+        self.combined = None
+        self.patterns = []
+        self.custom = []
+        combinable = []
+        for index, transition in enumerate(self.transitions):
+            answer = transition.answer
+            if answer.type == "A":
+                self.exact.setdefault(answer.answer.lower(), index)
+            elif answer.type == "R":
+                if self._combinable(answer.answer):
+                    combinable.append((index, answer.answer))
+                else:
+                    self.patterns.append((index, answer.answer))
+            else:
+                self.custom.append((index, answer))
+        if combinable:
+            alternatives = ['(?P<t%d>%s)' % pair for pair in combinable]
+            try:
+                self.combined = re.compile('|'.join(alternatives), re.IGNORECASE)
+            except re.error:
+                # Too many groups for one expression; match them one by one.
+                self.patterns = sorted(self.patterns + combinable)
+
+    def match(self, text, message, functions):
+        """Return the first matching transition, or None.
+
+        ``functions`` maps custom answer keywords to registered functions,
+        which are called with the message.
+        """
+        if not text:
+            return None
+        best = self.exact.get(text.lower())
+        if self.combined is not None:
+            match = self.combined.match(text)
+            if match is not None:
+                best = self._first(best, int(match.lastgroup[1:]))
+        for index, pattern in self.patterns:
+            if best is not None and index > best:
+                break
+            if re.match(pattern, text, re.IGNORECASE):
+                best = self._first(best, index)
+                break
+        for index, answer in self.custom:
+            if best is not None and index > best:
+                break
+            if answer.type != "C":
+                raise Exception("Don't know how to process answer type: %s", answer.type)
+            if answer.answer not in functions:
+                raise Exception("Can't find a function to match custom key: %s", answer)
+            if functions[answer.answer](message):
+                best = index
+                break
+        if best is None:
+            return None
+        return self.transitions[best]
+
+    @staticmethod
+    def _combinable(pattern):
+        """Whether the pattern can be safely wrapped in a named group.
+
+        Invalid patterns are left alone, so that the error surfaces (as it
+        used to) only when that answer is tried.
+        """
+        if UNCOMBINABLE.search(pattern):
+            return False
+        try:
+            re.compile(pattern)
+        except re.error:
+            return False
+        return True
+
+    @staticmethod
+    def _first(best, index):
+        return index if best is None else min(best, index)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_entry_count(apps, schema_editor):
+    """Sequence ids start at 1, so the last one is the number of entries."""
+    Entry = apps.get_model('decisiontree', 'Entry')
+    Session = apps.get_model('decisiontree', 'Session')
+    last_sequence = Entry.objects.filter(session=OuterRef('pk'))
+    last_sequence = last_sequence.order_by().values('session')
+    last_sequence = last_sequence.annotate(last=Max('sequence_id')).values('last')
+    Session.objects.update(entry_count=Coalesce(Subquery(last_sequence), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('decisiontree', '0010_auto_20190125_0850'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='entry_count',
+            field=models.PositiveIntegerField(default=0, help_text='The number of answers accepted so far.'),
+        ),
+        migrations.RunPython(backfill_entry_count, migrations.RunPython.noop),
+    ]
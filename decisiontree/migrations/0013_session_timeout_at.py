@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 18:02
+from __future__ import unicode_literals
+
+import datetime
+
+from django.db import migrations, models
+from django.db.models import F, Q
+
+
+def backfill_timeout_at(apps, schema_editor):
+    """Open sessions were due DECISIONTREE_TIMEOUT seconds after their last change."""
+    from decisiontree import conf
+    Session = apps.get_model('decisiontree', 'Session')
+    sessions = Session.objects.exclude(Q(state=None) | Q(canceled=True))
+    sessions = sessions.exclude(last_modified=None)
+    sessions.update(timeout_at=F('last_modified') + datetime.timedelta(seconds=conf.TIMEOUT))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('decisiontree', '0012_session_idle_index'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='session',
+            name='decisiontree_session_idle',
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='timeout_at',
+            field=models.DateTimeField(blank=True, help_text='When the current question times out. None if the session is complete.', null=True),
+        ),
+        migrations.AddField(
+            model_name='treestate',
+            name='timeout',
+            field=models.PositiveIntegerField(blank=True, help_text='The number of seconds the user has to answer before the question times out. If empty, DECISIONTREE_TIMEOUT is used.', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='session',
+            index=models.Index(fields=['timeout_at', 'state', 'canceled'], name='decisiontree_session_due'),
+        ),
+        migrations.RunPython(backfill_timeout_at, migrations.RunPython.noop),
+    ]
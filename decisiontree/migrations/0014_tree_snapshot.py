@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 18:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('decisiontree', '0013_session_timeout_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tree',
+            name='compiled',
+            field=models.TextField(blank=True, editable=False, help_text='JSON snapshot of the tree structure; empty if out of date. See decisiontree.compiled.'),
+        ),
+        migrations.AddField(
+            model_name='tree',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Incremented whenever the tree or any of its components change.'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 18:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def backfill_active(apps, schema_editor):
+    Session = apps.get_model('decisiontree', 'Session')
+    Session.objects.filter(Q(state=None) | Q(canceled=True)).update(active=False)
+
+
+def create_open_index(apps, schema_editor):
+    """Index only the open sessions, where the database supports it."""
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX decisiontree_session_open '
+            'ON decisiontree_session (connection_id, start_date) WHERE active')
+
+
+def drop_open_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS decisiontree_session_open')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('decisiontree', '0014_tree_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='active',
+            field=models.BooleanField(default=True, editable=False, help_text='False once the session is complete or canceled.'),
+        ),
+        migrations.AddIndex(
+            model_name='session',
+            index=models.Index(fields=['connection', 'start_date'], name='decisiontree_session_started'),
+        ),
+        migrations.RunPython(backfill_active, migrations.RunPython.noop),
+        migrations.RunPython(create_open_index, drop_open_index),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 18:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rapidsms', '0004_auto_20150801_2138'),
+        ('decisiontree', '0015_session_active'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedSession',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_id', models.PositiveIntegerField(help_text='The id the session had.', unique=True)),
+                ('start_date', models.DateTimeField()),
+                ('last_modified', models.DateTimeField(null=True)),
+                ('canceled', models.NullBooleanField()),
+                ('entry_count', models.PositiveIntegerField(default=0)),
+                ('data', models.TextField(help_text="The session's entries, as JSON.")),
+                ('archived', models.DateTimeField(auto_now_add=True)),
+                ('connection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rapidsms.Connection')),
+                ('tree', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_sessions', to='decisiontree.Tree')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedsession',
+            index=models.Index(fields=['tree', 'start_date'], name='decisiontree_archive_tree'),
+        ),
+    ]
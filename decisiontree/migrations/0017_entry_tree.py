@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 18:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models, transaction
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+CHUNK_SIZE = 10000
+
+
+def backfill_entry_tree(apps, schema_editor):
+    """Copy each entry's session's tree, one transaction per chunk of ids."""
+    Entry = apps.get_model('decisiontree', 'Entry')
+    Session = apps.get_model('decisiontree', 'Session')
+    tree = Subquery(Session.objects.filter(pk=OuterRef('session_id')).values('tree_id')[:1])
+    last = Entry.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    for start in range(0, last, CHUNK_SIZE):
+        with transaction.atomic():
+            entries = Entry.objects.filter(pk__gt=start, pk__lte=start + CHUNK_SIZE, tree=None)
+            entries.update(tree=tree)
+
+
+class Migration(migrations.Migration):
+    # so that the backfill commits chunk by chunk
+    atomic = False
+
+    dependencies = [
+        ('decisiontree', '0016_archivedsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='tree',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='decisiontree.Tree'),
+        ),
+        migrations.RunPython(backfill_entry_tree, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 18:23
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('decisiontree', '0017_entry_tree'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(db_index=True, help_text='Identifies the survey data which was exported.', max_length=40)),
+                ('archived', models.BooleanField(default=False, help_text='Whether archived sessions are included.')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('rows', models.PositiveIntegerField(default=0, help_text='The number of sessions written so far.')),
+                ('total', models.PositiveIntegerField(default=0, help_text='The number of sessions to write.')),
+                ('file', models.FileField(blank=True, upload_to='decisiontree/exports')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('tree', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='export_jobs', to='decisiontree.Tree')),
+            ],
+        ),
+    ]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 18:31
+from __future__ import unicode_literals
+
+import json
+from collections import Counter
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def count_answers(apps, schema_editor):
+    """Count the answers already given, as rebuild_answer_stats does."""
+    Entry = apps.get_model('decisiontree', 'Entry')
+    ArchivedSession = apps.get_model('decisiontree', 'ArchivedSession')
+    Transition = apps.get_model('decisiontree', 'Transition')
+    StateAnswerStats = apps.get_model('decisiontree', 'StateAnswerStats')
+    counts = Counter()
+    entries = Entry.objects.exclude(tree=None).values_list(
+        'tree', 'transition__current_state', 'transition__answer')
+    for tree_id, state_id, answer_id, count in entries.annotate(count=Count('pk')).order_by():
+        counts[(tree_id, state_id, answer_id)] += count
+    answer_ids = dict(Transition.objects.values_list('pk', 'answer_id'))
+    state_ids = set(apps.get_model('decisiontree', 'TreeState').objects.values_list(
+        'pk', flat=True))
+    for tree_id, data in ArchivedSession.objects.values_list('tree', 'data').iterator():
+        for entry in json.loads(data)['entries']:
+            answer_id = answer_ids.get(entry['transition_id'])
+            if answer_id is not None and entry['state_id'] in state_ids:
+                counts[(tree_id, entry['state_id'], answer_id)] += 1
+    StateAnswerStats.objects.bulk_create([
+        StateAnswerStats(tree_id=tree_id, state_id=state_id, answer_id=answer_id, count=count)
+        for (tree_id, state_id, answer_id), count in sorted(counts.items())
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('decisiontree', '0020_session_report_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StateAnswerStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('answer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answer_stats', to='decisiontree.Answer')),
+                ('state', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answer_stats', to='decisiontree.TreeState')),
+                ('tree', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answer_stats', to='decisiontree.Tree')),
+            ],
+            options={
+                'verbose_name_plural': 'state answer stats',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='stateanswerstats',
+            unique_together=set([('tree', 'state', 'answer')]),
+        ),
+        migrations.RunPython(count_answers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 19:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('decisiontree', '0021_state_answer_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, help_text='When the job last made progress.'),
+            preserve_default=False,
+        ),
+    ]
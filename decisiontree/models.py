@@ -1,12 +1,17 @@
 import datetime
+import json
+from collections import Counter, OrderedDict, defaultdict
 
 from django.conf import settings
-from django.db import models
-from django.db.models import Q
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
 from colorful.fields import RGBColorField
 
+from decisiontree.multitenancy.utils import multitenancy_enabled
+
 
 @python_2_unicode_compatible
 class Message(models.Model):
@@ -46,6 +51,17 @@ class Tree(models.Model):
         help_text="The first Message sent when this Tree is triggered, "
                   "which may lead to many more.")
     summary = models.CharField(max_length=160, blank=True)
+    compiled = models.TextField(
+        blank=True, editable=False,
+        help_text="JSON snapshot of the tree structure; empty if out of date. "
+                  "See decisiontree.compiled.")
+    version = models.PositiveIntegerField(
+        default=0, editable=False,
+        help_text="Incremented whenever the tree or any of its components change.")
+
+    # Only written by decisiontree.compiled, so that saving an instance loaded
+    # before the tree changed doesn't put back an old snapshot.
+    SNAPSHOT_FIELDS = ('compiled', 'version')
 
     class Meta(object):
         # The permission required for this tab to display in the UI.
@@ -57,15 +73,29 @@ class Tree(models.Model):
     def __str__(self):
         return u"T%s: %s -> %s" % (self.pk, self.trigger, self.root_state)
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.SNAPSHOT_FIELDS]
+        super(Tree, self).save(*args, **kwargs)
+
     def get_all_states(self):
-        all_states = []
-        all_states.append(self.root_state)
-        if self.root_state:
-            self.root_state.add_all_unique_children(all_states)
-        return all_states
+        """
+        Returns the states reachable from the root state, depth first, read
+        from the tree's snapshot.
+        """
+        from decisiontree.compiled import get_snapshot
+        version, snapshot = get_snapshot(self.pk)
+        states = TreeState.objects.select_related('message').in_bulk(snapshot['order'])
+        return [states[pk] for pk in snapshot['order']]
 
     def has_loops(self):
-        return self.root_state.has_loops_below()
+        return bool(self.find_loop())
+
+    def find_loop(self):
+        """Returns the states of a loop in the tree, in order, or an empty list."""
+        return self.root_state.find_loop_below()
 
 
 @python_2_unicode_compatible
@@ -132,6 +162,10 @@ class TreeState(models.Model):
         help_text="The number of tries the user has to get out of this state. "
                   "If empty, there is no limit. When the number of retries is "
                   "hit, the user's session will be terminated.")
+    timeout = models.PositiveIntegerField(
+        blank=True, null=True,
+        help_text="The number of seconds the user has to answer before the "
+                  "question times out. If empty, DECISIONTREE_TIMEOUT is used.")
 
     class Meta:
         verbose_name = 'survey state'
@@ -141,41 +175,124 @@ class TreeState(models.Model):
 
     def add_all_unique_children(self, added):
         """
-        Adds all unique children of the state to the passed in list.  This
-        happens recursively.
+        Adds all unique children of the state to the passed in list, depth
+        first and in transition order. States already in the list are not
+        descended into.
+        """
+        adjacency = TreeState.reachable_transitions([self.pk])
+        seen = set(state.pk for state in added if state)
+        children = list(depth_first(adjacency, self.pk, seen))[1:]
+        states = TreeState.objects.select_related('message').in_bulk(children)
+        added.extend(states[pk] for pk in children)
+
+    @classmethod
+    def reachable_transitions(klass, state_ids, transitions=None):
+        """
+        Loads the transitions of every state reachable from the given states.
+
+        Transitions are loaded a level at a time until no new states are
+        found, so the number of queries is bounded by the depth of the graph
+        rather than by the number of states. Returns a dict which maps state
+        ids to their transitions, in the order of ``transitions`` (by
+        default, all transitions by id).
         """
-        transitions = self.transition_set.select_related('next_state__message')
-        for transition in transitions:
-            if transition.next_state:
-                if transition.next_state not in added:
-                    added.append(transition.next_state)
-                    transition.next_state.add_all_unique_children(added)
+        if transitions is None:
+            transitions = Transition.objects.order_by('pk')
+        seen = set(state_ids)
+        frontier = set(seen)
+        adjacency = defaultdict(list)
+        while frontier:
+            queryset = transitions.filter(current_state__in=frontier)
+            frontier = set()
+            for transition in queryset:
+                adjacency[transition.current_state_id].append(transition)
+                if transition.next_state_id not in seen:
+                    seen.add(transition.next_state_id)
+                    frontier.add(transition.next_state_id)
+        return adjacency
 
     def has_loops_below(self):
-        return TreeState.path_has_loops([self])
+        return bool(self.find_loop_below())
+
+    def find_loop_below(self):
+        """
+        Returns the states of a loop reachable from this state, in order, or
+        an empty list if there is none.
+        """
+        return TreeState.find_path_loop([self])
 
     @classmethod
     def path_has_loops(klass, path):
-        # we're going to get all unique paths through the this
-        # (or until we hit a loop)
-        # a path is defined as an ordered set of states
-        # if at any point in a path we reach a state we've
-        # already seen then we have a loop
-        # this is basically a depth first search
-        last_node = path[len(path) - 1]
-        transitions = last_node.transition_set.all()
-        for transition in transitions:
-            if transition.next_state:
-                # Base case.  We have already seen this state in the path
-                if path.__contains__(transition.next_state):
-                    return True
-                next_path = path[:]
-                next_path.append(transition.next_state)
-                # recursive case - there is a loop somewhere below this path
-                if TreeState.path_has_loops(next_path):
-                    return True
-        # we trickle down to here - went all the way through without finding any loops
-        return False
+        return bool(klass.find_path_loop(path))
+
+    @classmethod
+    def find_path_loop(klass, path):
+        """
+        Returns the states of a loop reached by following transitions from the
+        last state of the path, or an empty list. A path is an ordered list of
+        states, so reaching any state in the path again is also a loop.
+        """
+        path_ids = [state.pk for state in path]
+        adjacency = klass.reachable_transitions(path_ids[-1:])
+        loop = find_cycle(adjacency, path_ids)
+        states = klass.objects.select_related('message').in_bulk(loop)
+        return [states[pk] for pk in loop]
+
+
+def depth_first(adjacency, start, seen=()):
+    """
+    Yields the ids of the states reachable from ``start``, itself first, in
+    depth first order following transitions in order.
+
+    ``adjacency`` maps state ids to their transitions. States in ``seen`` are
+    neither listed nor descended into.
+    """
+    seen = set(seen)
+    seen.add(start)
+    yield start
+    stack = [iter(adjacency[start])]
+    while stack:
+        for transition in stack[-1]:
+            if transition.next_state_id not in seen:
+                seen.add(transition.next_state_id)
+                yield transition.next_state_id
+                stack.append(iter(adjacency[transition.next_state_id]))
+                break
+        else:
+            stack.pop()
+
+
+def find_cycle(adjacency, path):
+    """
+    Finds a cycle in a graph of transitions, depth first.
+
+    ``adjacency`` maps state ids to their transitions and ``path`` is a list
+    of state ids, of which only the last is explored. States are on the
+    current path (grey), finished (black) or not yet seen (white); reaching a
+    grey state closes a cycle. Returns the ids of the states in the cycle, in
+    order, or an empty list. Each state is explored at most once, so this
+    takes time linear in the size of the graph.
+    """
+    path = list(path)
+    on_path = dict((pk, i) for i, pk in enumerate(path))
+    finished = set()
+    stack = [iter(adjacency[path[-1]])]
+    while stack:
+        for transition in stack[-1]:
+            pk = transition.next_state_id
+            if pk in on_path:
+                return path[on_path[pk]:]
+            if pk not in finished:
+                on_path[pk] = len(path)
+                path.append(pk)
+                stack.append(iter(adjacency[pk]))
+                break
+        else:
+            stack.pop()
+            pk = path.pop()
+            del on_path[pk]
+            finished.add(pk)
+    return []
 
 
 @python_2_unicode_compatible
@@ -203,7 +320,9 @@ class SessionQuerySet(models.query.QuerySet):
     _closed_conditions = Q(state=None) | Q(canceled=True)
 
     def open(self):
-        return self.exclude(self._closed_conditions)
+        # active lets the database use an index; the other conditions still
+        # apply to rows which were closed with queryset updates.
+        return self.filter(active=True).exclude(self._closed_conditions)
 
     def closed(self):
         return self.filter(self._closed_conditions)
@@ -233,13 +352,45 @@ class Session(models.Model):
     # on its own, or manually canceled.
     canceled = models.NullBooleanField(blank=True, null=True)
     last_modified = models.DateTimeField(auto_now=True, null=True)
+    entry_count = models.PositiveIntegerField(
+        default=0,
+        help_text="The number of answers accepted so far.")
+    timeout_at = models.DateTimeField(
+        blank=True, null=True,
+        help_text="When the current question times out. None if the session is complete.")
+    active = models.BooleanField(
+        default=True, editable=False,
+        help_text="False once the session is complete or canceled.")
 
     objects = SessionQuerySet.as_manager()
 
+    class Meta(object):
+        indexes = [
+            # open sessions by due time, for the timeout check
+            models.Index(fields=['timeout_at', 'state', 'canceled'],
+                         name='decisiontree_session_due'),
+            # latest sessions of a connection, for inbound messages
+            models.Index(fields=['connection', 'start_date'],
+                         name='decisiontree_session_started'),
+            # sessions changed since a delta export's cursor
+            models.Index(fields=['tree', 'last_modified'],
+                         name='decisiontree_session_modified'),
+            # pages of the survey report
+            models.Index(fields=['tree', 'start_date'],
+                         name='decisiontree_session_report'),
+        ]
+
     def __str__(self):
         state = self.state or "completed"
         return u"%s : %s" % (self.connection.identity, state)
 
+    def save(self, *args, **kwargs):
+        self.active = self.is_open()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'active' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['active']
+        super(Session, self).save(*args, **kwargs)
+
     def cancel(self):
         return self.close(canceled=True)
 
@@ -249,8 +400,9 @@ class Session(models.Model):
         No operation if session is already closed.
         """
         if not self.is_closed():
-            self.state_at_close = self.state
+            self.state_at_close_id = self.state_id
             self.state = None
+            self.timeout_at = None
             self.canceled = canceled
             self.save()
 
@@ -268,6 +420,8 @@ class Entry(models.Model):
     an accepted Transition from one state to another within the tree.
     """
     session = models.ForeignKey(Session, related_name='entries')
+    # the session's tree, so that reports don't need to join Session
+    tree = models.ForeignKey(Tree, related_name='entries', null=True, editable=False)
     sequence_id = models.IntegerField()
     transition = models.ForeignKey(Transition, related_name='entries')
     time = models.DateTimeField(auto_now_add=True, db_index=True)
@@ -283,6 +437,11 @@ class Entry(models.Model):
             self.session.pk, self.sequence_id,
             self.transition.current_state.message, self.text)
 
+    def save(self, *args, **kwargs):
+        if self.tree_id is None and self.session_id is not None:
+            self.tree_id = self.session.tree_id
+        super(Entry, self).save(*args, **kwargs)
+
     def display_text(self):
         # assume that the display text is just the text,
         # since this is what it is for free text entries
@@ -321,11 +480,221 @@ class TagNotification(models.Model):
 
     @classmethod
     def create_from_entry(cls, entry):
-        for tag in entry.tags.all():
-            for user in tag.recipients.all():
-                TagNotification.objects.get_or_create(tag=tag, entry=entry, user=user)
+        """Notifies the recipients of the entry's tags, unless already notified."""
+        recipients = Tag.recipients.through.objects.filter(tag__entries=entry)
+        recipients = recipients.values_list('tag_id', 'user_id')
+        existing = cls.objects.filter(entry=entry).values_list('tag_id', 'user_id')
+        existing = set(existing)
+        cls.create_in_bulk((entry.pk, tag_id, user_id) for tag_id, user_id in recipients
+                           if (tag_id, user_id) not in existing)
+
+    @classmethod
+    def create_in_bulk(cls, notifications):
+        """Creates notifications from (entry id, tag id, user id) triples.
+
+        Duplicate triples are skipped. Notifications are inserted with a
+        single query and, if multitenancy is enabled, linked to the tenants
+        of their tags with a couple more.
+        """
+        date_added = datetime.datetime.now()
+        objs = [cls(entry_id=entry_id, tag_id=tag_id, user_id=user_id,
+                    date_added=date_added)
+                for entry_id, tag_id, user_id in OrderedDict.fromkeys(notifications)]
+        if not objs:
+            return
+        cls.objects.bulk_create(objs)
+        if multitenancy_enabled():
+            cls._link_in_bulk(objs)
+
+    @classmethod
+    def _link_in_bulk(cls, objs):
+        """Links bulk created notifications to the tenants of their tags.
+
+        bulk_create doesn't send the post_save signal which would otherwise
+        create the links (see decisiontree.multitenancy.signals).
+        """
+        from .multitenancy.models import TagLink, TagNotificationLink
+        if any(obj.pk is None for obj in objs):
+            # only some databases return the ids of bulk inserted rows
+            ids = cls.objects.filter(entry__in=set(obj.entry_id for obj in objs))
+            ids = dict(((entry_id, tag_id, user_id), pk) for entry_id, tag_id, user_id, pk
+                       in ids.values_list('entry_id', 'tag_id', 'user_id', 'pk'))
+            for obj in objs:
+                obj.pk = ids[(obj.entry_id, obj.tag_id, obj.user_id)]
+        links = TagLink.all_tenants.filter(linked__in=set(obj.tag_id for obj in objs))
+        tenant_ids = dict(links.values_list('linked_id', 'tenant_id'))
+        TagNotificationLink.all_tenants.bulk_create([
+            TagNotificationLink(linked_id=obj.pk, tenant_id=tenant_ids.get(obj.tag_id))
+            for obj in objs
+        ])
 
     def save(self, **kwargs):
         if not self.pk:
             self.date_added = datetime.datetime.now()
         super(TagNotification, self).save(**kwargs)
+
+
+@python_2_unicode_compatible
+class ArchivedSession(models.Model):
+    """
+    A closed Session which was moved out of the Session and Entry tables by
+    decisiontree.archive, with its entries kept as JSON.
+    """
+    session_id = models.PositiveIntegerField(
+        unique=True, help_text="The id the session had.")
+    connection = models.ForeignKey('rapidsms.Connection')
+    tree = models.ForeignKey(Tree, related_name='archived_sessions')
+    start_date = models.DateTimeField()
+    last_modified = models.DateTimeField(null=True)
+    canceled = models.NullBooleanField()
+    entry_count = models.PositiveIntegerField(default=0)
+    data = models.TextField(help_text="The session's entries, as JSON.")
+    archived = models.DateTimeField(auto_now_add=True)
+
+    class Meta(object):
+        indexes = [
+            models.Index(fields=['tree', 'start_date'],
+                         name='decisiontree_archive_tree'),
+        ]
+
+    def __str__(self):
+        return u"%s : archived" % self.connection.identity
+
+    def get_entries(self):
+        """Returns the session's entries, in order, as dicts.
+
+        Each has the sequence_id, time (an ISO 8601 string), text,
+        transition_id, state_id, answer (the answer's name) and tags (a list
+        of tag names) of the entry.
+        """
+        return json.loads(self.data)['entries']
+
+
+@python_2_unicode_compatible
+class ExportJob(models.Model):
+    """
+    A survey export written to file storage by a background task (see
+    decisiontree.exports). Finished exports are reused for as long as the
+    survey's data stays the same.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+    tree = models.ForeignKey(Tree, related_name='export_jobs')
+    key = models.CharField(
+        max_length=40, db_index=True,
+        help_text="Identifies the survey data which was exported.")
+    archived = models.BooleanField(
+        default=False, help_text="Whether archived sessions are included.")
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    rows = models.PositiveIntegerField(
+        default=0, help_text="The number of sessions written so far.")
+    total = models.PositiveIntegerField(
+        default=0, help_text="The number of sessions to write.")
+    file = models.FileField(upload_to='decisiontree/exports', blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(
+        auto_now=True, help_text="When the job last made progress.")
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return u"%s export %s" % (self.tree.trigger, self.pk)
+
+    def is_available(self):
+        """Whether the export was written and is still in storage."""
+        return (self.status == self.DONE and bool(self.file) and
+                self.file.storage.exists(self.file.name))
+
+
+@python_2_unicode_compatible
+class StateAnswerStats(models.Model):
+    """
+    The number of times an answer was given to a state of a survey, kept up
+    to date as entries are created, so that results are read without
+    counting entries. Answers given in sessions which have since been
+    archived are still counted.
+    """
+    tree = models.ForeignKey(Tree, related_name='answer_stats')
+    state = models.ForeignKey(TreeState, related_name='answer_stats')
+    answer = models.ForeignKey(Answer, related_name='answer_stats')
+    count = models.PositiveIntegerField(default=0)
+    last_updated = models.DateTimeField(auto_now=True)
+
+    class Meta(object):
+        unique_together = [('tree', 'state', 'answer')]
+        verbose_name_plural = 'state answer stats'
+
+    def __str__(self):
+        return u"%s: %s (%d)" % (self.state, self.answer, self.count)
+
+    @classmethod
+    def add(cls, answers):
+        """Counts answers, given as (tree id, state id, answer id) triples.
+
+        This costs an update (or an insert, for a new answer) per distinct
+        triple, and should run in the transaction which creates the entries.
+        """
+        now = timezone.now()
+        # always in the same order, so concurrent updates don't deadlock
+        for (tree_id, state_id, answer_id), count in sorted(Counter(answers).items()):
+            stats = cls.objects.filter(tree=tree_id, state=state_id, answer=answer_id)
+            if stats.update(count=F('count') + count, last_updated=now):
+                continue
+            try:
+                with transaction.atomic():
+                    cls.objects.create(tree_id=tree_id, state_id=state_id,
+                                       answer_id=answer_id, count=count)
+            except IntegrityError:
+                # created by another transaction in the meantime
+                stats.update(count=F('count') + count, last_updated=now)
+
+    @classmethod
+    def rebuild(cls, tree_ids=None):
+        """Recounts the answers of surveys (by default, of every survey).
+
+        Answers are counted from the entries and archived sessions. The
+        surveys' rows are locked, so rebuilds of a survey run one at a time,
+        and so are their counts, so that answers added to them in the
+        meantime wait for the new counts rather than being lost. Returns the
+        number of answers counted.
+        """
+        with transaction.atomic():
+            trees = Tree.objects.select_for_update().order_by('pk')
+            stats = cls.objects.all()
+            if tree_ids is not None:
+                trees = trees.filter(pk__in=tree_ids)
+                stats = stats.filter(tree__in=tree_ids)
+            list(trees.values_list('pk', flat=True))
+            list(stats.select_for_update().order_by('pk').values_list('pk', flat=True))
+            counts = Counter()
+            entries = Entry.objects.exclude(tree=None)
+            archived = ArchivedSession.objects.all()
+            if tree_ids is not None:
+                entries = entries.filter(tree__in=tree_ids)
+                archived = archived.filter(tree__in=tree_ids)
+            entries = entries.values_list('tree', 'transition__current_state',
+                                          'transition__answer').annotate(count=Count('pk'))
+            for tree_id, state_id, answer_id, count in entries.order_by():
+                counts[(tree_id, state_id, answer_id)] += count
+            answer_ids = dict(Transition.objects.values_list('pk', 'answer_id'))
+            for tree_id, data in archived.values_list('tree', 'data').iterator():
+                for entry in json.loads(data)['entries']:
+                    # skip the answers of transitions which were deleted since
+                    answer_id = answer_ids.get(entry['transition_id'])
+                    if answer_id is not None:
+                        counts[(tree_id, entry['state_id'], answer_id)] += 1
+            state_ids = set(TreeState.objects.values_list('pk', flat=True))
+            stats.delete()
+            cls.objects.bulk_create([
+                cls(tree_id=tree_id, state_id=state_id, answer_id=answer_id, count=count)
+                for (tree_id, state_id, answer_id), count in sorted(counts.items())
+                if state_id in state_ids
+            ], batch_size=1000)
+        return sum(counts.values())
@@ -1,13 +1,18 @@
 """
 These signals handle creation/update of tenant links for objects that have a
-derived relationship to a tenant.
+derived relationship to a tenant, and keep the trigger index of
+decisiontree.compiled in sync with tenant assignments.
 """
 
-from django.db.models.signals import post_save
+from multitenancy.models import BackendLink
+
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
+from decisiontree import compiled
 from decisiontree import models as tree_models
 
+from . import models
 from . import utils
 
 
@@ -39,3 +44,12 @@ def create_tag_notification_tenant_link(sender, instance, **kwargs):
     tenant_link, _ = link_class.all_tenants.get_or_create(linked=instance)
     tenant_link.tenant_id = tenant_id
     tenant_link.save()
+
+
+@receiver(post_save, sender=models.TreeLink)
+@receiver(post_delete, sender=models.TreeLink)
+@receiver(post_save, sender=BackendLink)
+@receiver(post_delete, sender=BackendLink)
+def invalidate_trigger_index(sender, **kwargs):
+    """Triggers are indexed by tenant, so reassignments rebuild the index."""
+    compiled.reindex()
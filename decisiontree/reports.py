@@ -0,0 +1,114 @@
+"""
+Survey reports.
+
+A survey report has the answer counts of each state, which are kept up to
+date in StateAnswerStats, a summary of the answers to each state, which are
+grouped and counted by the database, and a matrix of the survey's sessions
+by state, which is shown a page at a time (newest first,
+DECISIONTREE_REPORT_PAGE_SIZE sessions per page). Pages are found by keyset
+pagination on the sessions' start date and id, so that every page, however
+far back, costs the same few queries.
+"""
+
+from collections import OrderedDict, defaultdict
+
+from django.db.models import Count, Q
+
+from . import conf
+from .models import Entry, StateAnswerStats
+
+
+def summarize(counts):
+    """Returns the mean, median and mode of values, given as (value, count) pairs.
+
+    The mean, and the median of an even number of values, are 'n/a' unless
+    every value is a whole number.
+    """
+    total = sum(count for value, count in counts)
+    try:
+        counts = [(int(value), count) for value, count in counts]
+        numeric = True
+    except (TypeError, ValueError):
+        numeric = False
+    counts = sorted(counts)
+    if numeric and total:
+        mean = sum(value * count for value, count in counts) / total
+    else:
+        mean = 'n/a'
+
+    def nth(n):
+        for value, count in counts:
+            if n < count:
+                return value
+            n -= count
+
+    if not total:
+        median = 'n/a'
+    elif total % 2 == 1:
+        median = nth(total // 2)
+    elif numeric:
+        median = (nth(total // 2 - 1) + nth(total // 2)) / 2
+    else:
+        median = 'n/a'
+    most = max([count for value, count in counts] or [0])
+    mode = [value for value, count in counts if count == most]
+    return {'mean': mean, 'median': median, 'mode': mode}
+
+
+def answer_stats(tree):
+    """Returns the statistics of the answers to each state, by state id.
+
+    Each has the number of times each answer was given (read from
+    StateAnswerStats), their total, and a summary of the entries' text (see
+    summarize).
+    """
+    counts = StateAnswerStats.objects.filter(tree=tree)
+    counts = counts.values_list('state', 'answer__name', 'count').order_by('answer__name')
+    stats = {}
+    for state_id, answer, count in counts:
+        stat = stats.setdefault(state_id, {'answers': OrderedDict(), 'total': 0})
+        stat['answers'][answer] = stat['answers'].get(answer, 0) + count
+        stat['total'] += count
+    entries = Entry.objects.filter(tree=tree).order_by()
+    values = defaultdict(list)
+    texts = entries.values_list('transition__current_state', 'text')
+    for state_id, text, count in texts.annotate(count=Count('pk')):
+        values[state_id].append((text, count))
+    for state_id, stat in stats.items():
+        stat.update(summarize(values[state_id]))
+    return stats
+
+
+def session_page(tree, states, before=None, size=None):
+    """Returns a page of the tree's sessions, newest first, and whether there are more.
+
+    The page starts after the session ``before``, if given. Each session gets
+    an ``ordered_states`` list of (state, entry) pairs, where entry is the
+    latest answer to the state or None, and each entry gets its tags as
+    ``cached_tags``.
+    """
+    size = size or conf.REPORT_PAGE_SIZE
+    sessions = tree.sessions.select_related('connection__contact', 'connection__backend')
+    sessions = sessions.order_by('-start_date', '-pk')
+    if before is not None:
+        sessions = sessions.filter(Q(start_date__lt=before.start_date) |
+                                   Q(start_date=before.start_date, pk__lt=before.pk))
+    sessions = list(sessions[:size + 1])
+    more = len(sessions) > size
+    sessions = sessions[:size]
+
+    entries = Entry.objects.filter(session__in=[session.pk for session in sessions])
+    entries = list(entries.select_related('transition').order_by('sequence_id', 'pk'))
+    tag_map = defaultdict(list)
+    entry_tags = Entry.tags.through.objects.filter(entry__in=[entry.pk for entry in entries])
+    for entry_tag in entry_tags.select_related('tag'):
+        tag_map[entry_tag.entry_id].append(entry_tag.tag)
+    entry_map = defaultdict(dict)
+    for entry in entries:
+        entry.cached_tags = tag_map[entry.pk]
+        # the latest answer to a state wins
+        entry_map[entry.session_id][entry.transition.current_state_id] = entry
+    for session in sessions:
+        session.ordered_states = [(state, entry_map[session.pk].get(state.pk))
+                                  for state in states]
+    return sessions, more
@@ -0,0 +1,85 @@
+"""
+Session timeouts.
+
+Whenever a session is moved to a state, i.e., whenever the caller is asked a
+question, the session is given a due time: the time by which the caller should
+have answered, after the state's own timeout or DECISIONTREE_TIMEOUT seconds.
+Due times are kept in the indexed Session.timeout_at column, so that finding
+the sessions which have timed out costs the same however many sessions are
+open, and a session times out as soon as the next check after its own
+deadline.
+"""
+
+import datetime
+import logging
+
+from django.db.models import Q
+from django.utils import timezone
+
+from . import conf
+from .models import Session
+
+
+logger = logging.getLogger(__name__)
+
+
+class TimeoutScheduler(object):
+    """Computes and looks up session due times.
+
+    ``clock`` returns the current time; it defaults to Django's
+    ``timezone.now`` and can be replaced, e.g., by a test clock.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock or timezone.now
+
+    def now(self):
+        return self.clock()
+
+    def due_time(self, state, now=None):
+        """Returns when an answer to the compiled state is due.
+
+        Returns None if there is no state, i.e., the session is closed.
+        """
+        if state is None:
+            return None
+        timeout = conf.TIMEOUT if state.timeout is None else state.timeout
+        if now is None:
+            now = self.now()
+        return now + datetime.timedelta(seconds=timeout)
+
+    def due(self, now=None):
+        """Returns the open sessions which are past due, earliest first."""
+        if now is None:
+            now = self.now()
+        sessions = Session.objects.open().filter(timeout_at__lte=now)
+        return sessions.order_by('timeout_at', 'pk')
+
+    def run(self, callback, chunk_size=None):
+        """Calls ``callback`` with the sessions which are past due.
+
+        Sessions are loaded in order of due time, ``chunk_size`` (by default
+        DECISIONTREE_TIMEOUT_CHUNK_SIZE) at a time, and the callback is called
+        with each chunk. It returns how many of the sessions timed out.
+        Returns the number of sessions scanned and the number which timed
+        out.
+        """
+        chunk_size = chunk_size or conf.TIMEOUT_CHUNK_SIZE
+        sessions = self.due().select_related('connection__backend')
+        scanned = timed_out = 0
+        last = None
+        while True:
+            # page by (due time, id), as callbacks move the sessions on
+            chunk = sessions
+            if last is not None:
+                chunk = chunk.filter(Q(timeout_at__gt=last[0]) |
+                                     Q(timeout_at=last[0], pk__gt=last[1]))
+            chunk = list(chunk[:chunk_size].iterator())
+            if chunk:
+                last = (chunk[-1].timeout_at, chunk[-1].pk)
+                timed_out += callback(chunk)
+            scanned += len(chunk)
+            if len(chunk) < chunk_size:
+                break
+        logger.info('%d of %d due sessions timed out', timed_out, scanned)
+        return scanned, timed_out
@@ -0,0 +1,90 @@
+"""
+Cache of the open session of each connection.
+
+Every inbound message needs to know whether its connection is part-way
+through a tree, and if so in which state. Rather than querying the Session
+table for every message, a small pointer (session id, tree, state, number of
+tries and number of entries) is kept in Django's cache, so that it is shared
+by all router workers. The pointer is written whenever App moves a session
+forward and is discarded whenever a Session is saved or deleted some other
+way; a cache miss costs a single query. Pointers loaded after a miss are
+only added to the cache, so they never replace one written in the meantime.
+"""
+
+from collections import namedtuple
+
+from django.core.cache import caches
+
+from . import conf
+from .models import Session
+
+
+SessionPointer = namedtuple('SessionPointer', [
+    'session_id', 'connection_id', 'tree_id', 'state_id', 'num_tries',
+    'entry_count',
+])
+
+# Cached when a connection has no open session, so that messages from
+# connections which aren't taking a survey don't hit the database either.
+# It is kept for DECISIONTREE_SESSION_CACHE_MISS_TIMEOUT seconds only, in
+# case a session started meanwhile was forgotten before it was looked up.
+NO_SESSION = ()
+
+
+def get_cache():
+    return caches[conf.CACHE_ALIAS]
+
+
+def cache_key(connection_id):
+    return 'decisiontree:session:%s' % connection_id
+
+
+def pointer_for(session):
+    """Returns a SessionPointer for a Session instance."""
+    return SessionPointer(
+        session_id=session.pk,
+        connection_id=session.connection_id,
+        tree_id=session.tree_id,
+        state_id=session.state_id,
+        num_tries=session.num_tries,
+        entry_count=session.entry_count,
+    )
+
+
+def get_pointer(connection):
+    """Returns a SessionPointer to the connection's latest open session.
+
+    Returns None if the connection has no open session.
+    """
+    key = cache_key(connection.pk)
+    pointer = get_cache().get(key)
+    if pointer is None:
+        sessions = Session.objects.open().filter(connection=connection)
+        session = sessions.order_by('-start_date', '-pk').first()
+        pointer = pointer_for(session) if session else NO_SESSION
+        timeout = conf.SESSION_CACHE_TIMEOUT if session else conf.SESSION_CACHE_MISS_TIMEOUT
+        if not get_cache().add(key, tuple(pointer), timeout):
+            # set_pointer was called since the query, so its pointer is newer
+            pointer = get_cache().get(key, pointer)
+    if pointer and len(pointer) != len(SessionPointer._fields):
+        # Written by an older version of this module.
+        get_cache().delete(key)
+        return get_pointer(connection)
+    return SessionPointer(*pointer) if pointer else None
+
+
+def set_pointer(pointer):
+    """Records the current state of an open session."""
+    key = cache_key(pointer.connection_id)
+    get_cache().set(key, tuple(pointer), conf.SESSION_CACHE_TIMEOUT)
+
+
+def set_pointers(pointers):
+    """Records the current state of several open sessions at once."""
+    get_cache().set_many(dict((cache_key(p.connection_id), tuple(p)) for p in pointers),
+                         conf.SESSION_CACHE_TIMEOUT)
+
+
+def clear_pointer(connection_id):
+    """Forgets the connection's session; the next lookup will query for it."""
+    get_cache().delete(cache_key(connection_id))
@@ -1,4 +1,98 @@
+from django.conf import settings
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_save, pre_delete, pre_save)
 from django.dispatch import Signal
 
+from . import compiled
+from . import models
+from . import session_cache
+
 
 session_end_signal = Signal(providing_args=["session", "cancelled"])
+
+
+# How to find the states that use an object, by the object's model.
+STATE_LOOKUPS = {
+    'decisiontree.treestate': 'pk',
+    'decisiontree.transition': 'transition',
+    'decisiontree.answer': 'transition__answer',
+    'decisiontree.message': 'message',
+    'decisiontree.tag': 'transition__tags',
+    settings.AUTH_USER_MODEL.lower(): 'transition__tags__recipients',
+}
+
+
+def invalidate_trees_using(model, pks):
+    """Invalidate the compiled trees that use the objects."""
+    lookup = STATE_LOOKUPS[model._meta.label_lower] + '__in'
+    states = models.TreeState.objects.filter(**{lookup: pks})
+    tree_ids = compiled.find_tree_ids(states.values_list('pk', flat=True).distinct())
+    if tree_ids:
+        compiled.invalidate(tree_ids)
+
+
+def invalidate_compiled_trees(sender, instance, **kwargs):
+    """Part of some trees has changed, so their compiled trees must be rebuilt."""
+    # A transition moved away from a state changes that state's tree too.
+    old_state_id = getattr(instance, '_old_current_state_id', None)
+    if old_state_id is not None:
+        invalidate_trees_using(models.TreeState, [old_state_id])
+    invalidate_trees_using(sender, [instance.pk])
+
+
+def remember_current_state(sender, instance, raw=False, **kwargs):
+    """Note which state a transition is being moved away from."""
+    instance._old_current_state_id = None
+    if instance.pk and not raw:
+        old = models.Transition.objects.filter(pk=instance.pk)
+        old_state_id = old.values_list('current_state_id', flat=True).first()
+        if old_state_id != instance.current_state_id:
+            instance._old_current_state_id = old_state_id
+
+
+def invalidate_compiled_trees_m2m(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """Tags or their recipients have changed."""
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse and pk_set:
+        invalidate_trees_using(model, pk_set)
+    else:
+        invalidate_trees_using(type(instance), [instance.pk])
+
+
+def invalidate_compiled_tree(sender, instance, **kwargs):
+    """A tree has changed, so its compiled tree must be rebuilt."""
+    compiled.invalidate([instance.pk])
+
+
+post_save.connect(invalidate_compiled_tree, sender=models.Tree)
+post_delete.connect(invalidate_compiled_tree, sender=models.Tree)
+# Deletions are handled before the rows go, while the trees can still be found.
+pre_save.connect(remember_current_state, sender=models.Transition)
+for model in (models.TreeState, models.Transition,
+              models.Answer, models.Message, models.Tag):
+    post_save.connect(invalidate_compiled_trees, sender=model)
+    pre_delete.connect(invalidate_compiled_trees, sender=model)
+m2m_changed.connect(invalidate_compiled_trees_m2m, sender=models.Transition.tags.through)
+m2m_changed.connect(invalidate_compiled_trees_m2m, sender=models.Tag.recipients.through)
+# Deleting a user removes them from tag recipients without an m2m_changed.
+pre_delete.connect(invalidate_compiled_trees, sender=settings.AUTH_USER_MODEL)
+
+
+def delete_answer_stats(sender, instance, **kwargs):
+    """A path's entries go with it, so its answers are no longer counted."""
+    # a state has one path per answer, so the counts were all of this path
+    models.StateAnswerStats.objects.filter(
+        state=instance.current_state_id, answer=instance.answer_id).delete()
+
+
+post_delete.connect(delete_answer_stats, sender=models.Transition)
+
+
+def clear_session_pointer(sender, instance, **kwargs):
+    """The session changed outside of App, so look it up again."""
+    session_cache.clear_pointer(instance.connection_id)
+
+
+post_save.connect(clear_session_pointer, sender=models.Session)
+post_delete.connect(clear_session_pointer, sender=models.Session)
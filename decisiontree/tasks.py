@@ -1,64 +1,179 @@
 import datetime
 import logging
 import smtplib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 
 from celery.task import task
 
 from rapidsms.router.api import get_router
 
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage, get_connection
 from django.template.loader import render_to_string
 from django.utils.datastructures import MultiValueDict
 
-from .models import Session, TagNotification
+from . import archive
+from . import conf
+from . import exports
+from .locks import exclusive
+from .models import TagNotification
 
 
 logger = logging.getLogger(__name__)
 
 
 @task
+@exclusive('check_for_session_timeout')
 def check_for_session_timeout():
     """
     Check sessions and send a reminder if they have not responded in
     the given threshold.
+
+    Only open sessions whose question is past due are loaded, in order of
+    due time and DECISIONTREE_TIMEOUT_CHUNK_SIZE at a time, and each chunk is
+    timed out together. Returns the number of sessions scanned and the
+    number which timed out, or None if the previous run is still going.
     """
     router = get_router()
     app = router.get_app('decisiontree')
-    for session in Session.objects.open():
-        app.tick(session)
+    scanned, timed_out = app.scheduler.run(app.timeout_many)
+    return {'scanned': scanned, 'timed_out': timed_out}
 
 
 @task
+@exclusive('status_update')
 def status_update():
+    """
+    Email each user a digest of the tagged entries they haven't been
+    notified of yet.
+
+    Notifications are streamed grouped by email address and each
+    recipient's notifications are marked as sent with a single update.
+    Digests are rendered and sent over a single mail connection or, if
+    DECISIONTREE_DIGEST_WORKERS is more than one, by that many threads with
+    a mail connection each. Returns the number of digests sent and failed
+    and the number of notifications sent, or None if the previous run is
+    still going.
+    """
     logger.debug('status update task running')
     notifications = TagNotification.objects.filter(sent=False)
-    notifications = notifications.select_related().order_by('tag', 'entry')
-    logger.info('found {0} notifications'.format(notifications.count()))
-    users = {}
-    for notification in notifications:
-        email = notification.user.email
-        if email not in users:
-            users[email] = []
-        users[email].append(notification)
-    for email, notifications in users.iteritems():
-        tags = MultiValueDict()
-        for notification in notifications:
-            tags.appendlist(notification.tag, notification)
-        context = {'tags': tags}
-        body = render_to_string('tree/emails/digest.txt', context)
-        try:
-            send_mail(subject='Survey Response Report', message=body,
-                      recipient_list=[email],
-                      from_email=settings.DEFAULT_FROM_EMAIL,
-                      fail_silently=False)
-            sent = True
-        except smtplib.SMTPException, e:
-            logger.exception(e)
-            sent = False
+    notifications = notifications.select_related(
+        'tag', 'user', 'entry__transition__current_state__message',
+        'entry__session__connection__contact')
+    notifications = notifications.order_by('user__email', 'tag', 'entry')
+    digests = _group_digests(notifications.iterator())
+    if conf.DIGEST_WORKERS > 1:
+        results = _send_in_pool(digests, conf.DIGEST_WORKERS)
+    else:
+        results = _send_serially(digests)
+    summary = {'sent': 0, 'failed': 0, 'notifications': 0}
+    for email, ids, sent in results:
         if sent:
-            for notification in notifications:
-                notification.sent = True
-                notification.date_sent = datetime.datetime.now()
-                notification.save()
+            sent_notifications = TagNotification.objects.filter(pk__in=ids)
+            sent_notifications.update(sent=True, date_sent=datetime.datetime.now())
+            summary['sent'] += 1
+            summary['notifications'] += len(ids)
             logger.info('Sent report to %s' % email)
+        else:
+            summary['failed'] += 1
+    logger.info('sent {sent} digests ({notifications} notifications), '
+                '{failed} failed'.format(**summary))
+    return summary
+
+
+@task
+@exclusive('archive_sessions')
+def archive_sessions():
+    """
+    Archive the sessions which closed more than DECISIONTREE_ARCHIVE_AFTER
+    days ago, DECISIONTREE_ARCHIVE_CHUNK_SIZE at a time. Returns the number
+    of sessions archived, or None if the previous run is still going.
+    """
+    return archive.archive_sessions()
+
+
+@task
+def export_survey(job_id):
+    """
+    Write the survey export of ExportJob ``job_id`` to file storage,
+    recording its progress as it goes.
+    """
+    exports.run_job(job_id)
+
+
+def _group_digests(notifications):
+    """Yields (email, tags, notification ids) for each recipient."""
+    for email, group in groupby(notifications, lambda n: n.user.email):
+        tags = MultiValueDict()
+        ids = []
+        for notification in group:
+            tags.appendlist(notification.tag, notification)
+            ids.append(notification.pk)
+        yield email, tags, ids
+
+
+def _send_digest(email, tags, connection):
+    """Renders and sends one digest; returns whether it was sent."""
+    context = {'tags': tags}
+    body = render_to_string('tree/emails/digest.txt', context)
+    message = EmailMessage(subject='Survey Response Report', body=body,
+                           to=[email], from_email=settings.DEFAULT_FROM_EMAIL,
+                           connection=connection)
+    try:
+        # opened on first use and kept open; send_messages would
+        # otherwise close a connection it opened itself
+        connection.open()
+        connection.send_messages([message])
+    except smtplib.SMTPException as e:
+        logger.exception(e)
+        return False
+    return True
+
+
+def _send_serially(digests):
+    """Sends the digests one after another over a single mail connection.
+
+    Yields (email, notification ids, whether it was sent) for each digest.
+    """
+    connection = get_connection(fail_silently=False)
+    try:
+        for email, tags, ids in digests:
+            yield email, ids, _send_digest(email, tags, connection)
+    finally:
+        connection.close()
+
+
+def _send_in_pool(digests, workers):
+    """Sends the digests from a pool of threads, with a mail connection each.
+
+    Yields (email, notification ids, whether it was sent) for each digest,
+    in order. At most twice as many digests as there are workers are held
+    in memory at a time. Only the calling thread uses the database.
+    """
+    local = threading.local()
+    connections = []
+
+    def send(email, tags):
+        connection = getattr(local, 'connection', None)
+        if connection is None:
+            connection = local.connection = get_connection(fail_silently=False)
+            connections.append(connection)
+        return _send_digest(email, tags, connection)
+
+    pending = deque()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for email, tags, ids in digests:
+                pending.append((email, ids, pool.submit(send, email, tags)))
+                if len(pending) >= workers * 2:
+                    email, ids, future = pending.popleft()
+                    yield email, ids, future.result()
+            while pending:
+                email, ids, future = pending.popleft()
+                yield email, ids, future.result()
+    finally:
+        for connection in connections:
+            connection.close()
@@ -8,6 +8,7 @@ from multitenancy.models import TenantRole
 
 from django.conf import settings
 from django.contrib.auth import login
+from django.core.cache import cache
 from django.core.urlresolvers import reverse, reverse_lazy
 from django.http import HttpRequest
 from django.test import TestCase
@@ -21,6 +22,7 @@ class DecisionTreeTestCase(TestCase):
 
     def setUp(self):
         super(DecisionTreeTestCase, self).setUp()
+        cache.clear()
         self.tenant = mommy.make('multitenancy.Tenant')
         self.backend = mommy.make('rapidsms.Backend')
         self.backend_link = mommy.make('multitenancy.BackendLink',
@@ -1,3 +1,4 @@
+import mock
 from model_mommy import mommy
 
 from django.conf import settings
@@ -5,6 +6,7 @@ from django.core import mail
 
 from rapidsms.messages.incoming import IncomingMessage
 
+from decisiontree import conf
 from decisiontree import tasks
 from decisiontree import models as dt
 
@@ -51,6 +53,14 @@ class BasicSurveyTest(DecisionTreeTestCase):
         msg = self._send('bad-answer')
         self.assertTrue('is not a valid answer' in msg.responses[0]['text'])
 
+    def test_answer_stats(self):
+        for i in range(2):
+            self._send('food')
+            self._send(self.answer.answer)
+        stats = dt.StateAnswerStats.objects.get()
+        self.assertEqual((stats.tree, stats.state, stats.answer, stats.count),
+                         (self.survey, self.survey.root_state, self.answer, 2))
+
     def test_error_response_from_message(self):
         self.survey.root_state.message.error_response = 'my error response'
         self.survey.root_state.message.save()
@@ -78,6 +88,23 @@ class BasicSurveyTest(DecisionTreeTestCase):
         entry = transition2.entries.order_by('-sequence_id')[0]
         self.assertEqual(entry.sequence_id, 2)
 
+    def test_entry_count(self):
+        self._send('food')
+        self._send(self.transition.answer.answer)
+        session = self.connection.session_set.all()[0]
+        self.assertEqual(session.entry_count, 1)
+
+    def test_entry_tree(self):
+        self._send('food')
+        self._send(self.transition.answer.answer)
+        self.assertEqual(self.transition.entries.get().tree, self.survey)
+
+    def test_inactive_at_end(self):
+        self._send('food')
+        self.assertTrue(self.connection.session_set.get().active)
+        self._send(self.transition.answer.answer)
+        self.assertFalse(self.connection.session_set.get().active)
+
     def test_sequence_end(self):
         self._send('food')
         session = self.connection.session_set.all()[0]
@@ -110,6 +137,144 @@ class BasicSurveyTest(DecisionTreeTestCase):
         self.assertIn("Sorry, invalid answer 2 times", msg.responses[0]['text'])
 
 
+class HandleManyTest(DecisionTreeTestCase):
+
+    def setUp(self):
+        super(HandleManyTest, self).setUp()
+        self.survey = mommy.make('decisiontree.Tree', trigger='food')
+        mommy.make(
+            'decisiontree_multitenancy.TreeLink', linked=self.survey, tenant=self.tenant)
+        self.trans1 = mommy.make(
+            'decisiontree.Transition', current_state=self.survey.root_state,
+            answer=mommy.make('decisiontree.Answer', type='A'),
+            next_state=mommy.make('decisiontree.TreeState'))
+        self.trans2 = mommy.make(
+            'decisiontree.Transition', current_state=self.trans1.next_state,
+            answer=mommy.make('decisiontree.Answer', type='A'),
+            next_state=mommy.make('decisiontree.TreeState'))
+        self.tag = mommy.make('decisiontree.Tag', name='fruit')
+        self.trans1.tags.add(self.tag)
+        self.other = mommy.make('rapidsms.Connection', backend=self.backend,
+                                identity='4445556666')
+
+    def _texts(self, messages):
+        return [[response['text'] for response in msg.responses] for msg in messages]
+
+    def test_same_as_handle(self):
+        texts = ['food', 'bad-answer', self.trans1.answer.answer, 'nope',
+                 self.trans2.answer.answer, 'food', 'end']
+        one_by_one = [IncomingMessage([self.connection], text) for text in texts]
+        results = [self.app.handle(msg) for msg in one_by_one]
+        batched = [IncomingMessage([self.other], text) for text in texts]
+        self.assertEqual(self.app.handle_many(batched), results)
+        self.assertEqual(self._texts(batched), self._texts(one_by_one))
+        fields = ('state', 'num_tries', 'entry_count', 'canceled', 'active')
+        self.assertEqual(list(self.other.session_set.order_by('pk').values_list(*fields)),
+                         list(self.connection.session_set.order_by('pk').values_list(*fields)))
+        fields = ('sequence_id', 'transition', 'text', 'tree')
+        self.assertEqual(
+            list(dt.Entry.objects.filter(session__connection=self.other).values_list(*fields)),
+            list(dt.Entry.objects.filter(session__connection=self.connection).values_list(*fields)))
+
+    def test_interleaved_connections(self):
+        messages = [
+            IncomingMessage([self.connection], 'food'),
+            IncomingMessage([self.other], 'food'),
+            IncomingMessage([self.connection], self.trans1.answer.answer),
+            IncomingMessage([self.other], 'bad-answer'),
+        ]
+        self.assertEqual(self.app.handle_many(messages), [True] * 4)
+        self.assertIn(self.trans1.next_state.message.text, messages[2].responses[0]['text'])
+        self.assertIn(conf.INVALID_ANSWER_RESPONSE, messages[3].responses[0]['text'])
+        entry = dt.Entry.objects.get()
+        self.assertEqual(entry.session.connection, self.connection)
+        self.assertEqual(list(entry.tags.all()), [self.tag])
+
+    def test_answers_written_in_bulk(self):
+        connections = [self.connection, self.other]
+        for connection in connections:
+            self.app.handle(IncomingMessage([connection], 'food'))
+        messages = [IncomingMessage([connection], self.trans1.answer.answer)
+                    for connection in connections]
+        stats = dt.StateAnswerStats.objects.create(
+            tree=self.survey, state=self.survey.root_state, answer=self.trans1.answer)
+        # savepoint, lock sessions, update sessions, insert entries, update
+        # answer stats, load entry ids, load session tenants, insert entry
+        # links, insert entry tags, release savepoint
+        with self.assertNumQueries(10):
+            self.app.handle_many(messages)
+        self.assertEqual(dt.Entry.objects.filter(sequence_id=1).count(), 2)
+        self.assertEqual(dt.StateAnswerStats.objects.get(pk=stats.pk).count, 2)
+        for connection in connections:
+            session = connection.session_set.get()
+            self.assertEqual(session.state, self.trans1.next_state)
+            self.assertEqual(session.entry_count, 1)
+
+    def test_entries_linked_to_tenant(self):
+        connections = [self.connection, self.other]
+        for connection in connections:
+            self.app.handle(IncomingMessage([connection], 'food'))
+        self.app.handle_many([IncomingMessage([connection], self.trans1.answer.answer)
+                              for connection in connections])
+        entries = dt.Entry.objects.all()
+        self.assertEqual(len(entries), 2)
+        for entry in entries:
+            self.assertEqual(entry.tenantlink.tenant, self.tenant)
+
+    def test_no_session(self):
+        msg = IncomingMessage([self.connection], 'hello')
+        self.assertEqual(self.app.handle_many([msg]), [False])
+        self.assertEqual(msg.responses, [])
+
+
+@mock.patch('decisiontree.app.send')
+class TimeoutTest(DecisionTreeTestCase):
+
+    def setUp(self):
+        super(TimeoutTest, self).setUp()
+        self.survey = mommy.make('decisiontree.Tree', trigger='food')
+        mommy.make(
+            'decisiontree_multitenancy.TreeLink', linked=self.survey, tenant=self.tenant)
+        self.transition = mommy.make(
+            'decisiontree.Transition', current_state=self.survey.root_state,
+            answer=mommy.make('decisiontree.Answer', type='A', answer='TimeOut'),
+            next_state=mommy.make('decisiontree.TreeState'))
+        mommy.make('decisiontree.Transition', current_state=self.transition.next_state)
+        self.other = mommy.make('rapidsms.Connection', backend=self.backend)
+        for connection in (self.connection, self.other):
+            self.app.handle(IncomingMessage([connection], 'food'))
+        self.router.incoming = mock.Mock()
+
+    def test_timeout_answer(self, send):
+        session = self.connection.session_set.get()
+        self.assertTrue(self.app.timeout(session))
+        session = self.connection.session_set.get()
+        self.assertEqual(session.state, self.transition.next_state)
+        self.assertEqual(session.entries.get().text, 'TimeOut')
+        send.assert_called_once_with(mock.ANY, [self.connection])
+        self.assertIn(self.transition.next_state.message.text, send.call_args[0][0])
+        self.assertFalse(self.router.incoming.called)
+
+    def test_invalid_timeout_answer(self, send):
+        self.transition.answer.answer = 'later'
+        self.transition.answer.save()
+        session = self.connection.session_set.get()
+        self.assertTrue(self.app.timeout(session))
+        self.assertEqual(self.connection.session_set.get().num_tries, 1)
+        self.assertIn(conf.INVALID_ANSWER_RESPONSE, send.call_args[0][0])
+
+    def test_same_responses_sent_together(self, send):
+        sessions = dt.Session.objects.order_by('pk')
+        self.assertEqual(self.app.timeout_many(sessions), 2)
+        send.assert_called_once_with(mock.ANY, [self.connection, self.other])
+
+    def test_closed_session(self, send):
+        session = self.connection.session_set.get()
+        session.close()
+        self.assertFalse(self.app.timeout(session))
+        self.assertFalse(send.called)
+
+
 class DigestTest(DecisionTreeTestCase):
 
     def setUp(self):
@@ -147,6 +312,30 @@ class DigestTest(DecisionTreeTestCase):
         notification = dt.TagNotification.objects.all()[0]
         self.assertEqual(notification.entry.pk, entry.pk)
 
+    @mock.patch('decisiontree.models.multitenancy_enabled', return_value=False)
+    def test_auto_tag_notifications_in_bulk(self, multitenancy_enabled):
+        other_user = mommy.make(settings.AUTH_USER_MODEL, email='b@b.com')
+        self.fruit_tag.recipients.add(other_user)
+        veggie_tag = mommy.make('decisiontree.Tag', name='veggie')
+        veggie_tag.recipients.add(self.user)
+        trans1 = mommy.make(
+            'decisiontree.Transition', current_state=self.survey.root_state,
+            answer=mommy.make('decisiontree.Answer', type='A'),
+            next_state=mommy.make('decisiontree.TreeState'))
+        trans1.tags.add(self.fruit_tag, veggie_tag)
+
+        self._send('food')
+        self._send(trans1.answer.answer)
+        entry = trans1.entries.get()
+        self.assertEqual(set(entry.tags.all()), set([self.fruit_tag, veggie_tag]))
+        notifications = dt.TagNotification.objects.values_list('tag', 'user', 'entry')
+        self.assertEqual(set(notifications), set([
+            (self.fruit_tag.pk, self.user.pk, entry.pk),
+            (self.fruit_tag.pk, other_user.pk, entry.pk),
+            (veggie_tag.pk, self.user.pk, entry.pk),
+        ]))
+        self.assertTrue(all(n.date_added for n in dt.TagNotification.objects.all()))
+
     def test_task(self):  # TODO: move to separate module
         trans1 = mommy.make(
             'decisiontree.Transition', current_state=self.survey.root_state,
@@ -0,0 +1,83 @@
+import datetime
+
+import mock
+from model_mommy import mommy
+
+from django.utils import timezone
+
+from decisiontree import archive
+from decisiontree import models as dt
+
+from .cases import DecisionTreeTestCase
+
+
+class ArchiveTest(DecisionTreeTestCase):
+
+    def setUp(self):
+        super(ArchiveTest, self).setUp()
+        self.survey = mommy.make('decisiontree.Tree', trigger='food')
+        self.transition = mommy.make(
+            'decisiontree.Transition', current_state=self.survey.root_state,
+            answer=mommy.make('decisiontree.Answer', name='apple'))
+        self.tag = mommy.make('decisiontree.Tag', name='fruit')
+        mommy.make('decisiontree_multitenancy.TagLink', linked=self.tag, tenant=self.tenant)
+
+    def _make_session(self, days_ago, entries=0, **kwargs):
+        kwargs.setdefault('state', None)
+        session = mommy.make('decisiontree.Session', connection=self.connection,
+                             tree=self.survey, num_tries=0, **kwargs)
+        for i in range(entries):
+            mommy.make('decisiontree.Entry', session=session, sequence_id=i + 1,
+                       transition=self.transition, text='apple %d' % i)
+        modified = timezone.now() - datetime.timedelta(days=days_ago)
+        dt.Session.objects.filter(pk=session.pk).update(last_modified=modified)
+        return session
+
+    def test_old_closed_sessions(self):
+        old = self._make_session(40, entries=2)
+        recent = self._make_session(10)
+        still_open = self._make_session(40, state=self.survey.root_state)
+        self.assertEqual(archive.archive_sessions(days=30), 1)
+        self.assertEqual(set(dt.Session.objects.values_list('pk', flat=True)),
+                         set([recent.pk, still_open.pk]))
+        self.assertFalse(dt.Entry.objects.exists())
+        archived = dt.ArchivedSession.objects.get()
+        self.assertEqual(archived.session_id, old.pk)
+        self.assertEqual(archived.tree, self.survey)
+        self.assertEqual(archived.entry_count, 2)
+        entries = archived.get_entries()
+        self.assertEqual([entry['text'] for entry in entries], ['apple 0', 'apple 1'])
+        self.assertEqual(entries[0]['state_id'], self.survey.root_state.pk)
+        self.assertEqual(entries[0]['answer'], 'apple')
+
+    def test_tags(self):
+        self._make_session(40, entries=1)
+        entry = dt.Entry.objects.get()
+        entry.tags.add(self.tag)
+        mommy.make('decisiontree.TagNotification', entry=entry, tag=self.tag, sent=True)
+        self.assertEqual(archive.archive_sessions(days=30), 1)
+        self.assertEqual(dt.ArchivedSession.objects.get().get_entries()[0]['tags'], ['fruit'])
+        self.assertFalse(dt.Entry.tags.through.objects.exists())
+        self.assertFalse(dt.TagNotification.objects.exists())
+
+    def test_unsent_notifications(self):
+        """Sessions are kept until their tag notifications are emailed."""
+        self._make_session(40, entries=1)
+        mommy.make('decisiontree.TagNotification', entry=dt.Entry.objects.get(),
+                   tag=self.tag, sent=False)
+        self.assertEqual(archive.archive_sessions(days=30), 0)
+        self.assertEqual(dt.Session.objects.count(), 1)
+
+    def test_chunks(self):
+        for i in range(5):
+            self._make_session(40, entries=1)
+        with mock.patch('decisiontree.archive.archive', wraps=archive.archive) as chunk:
+            self.assertEqual(archive.archive_sessions(days=30, chunk_size=2), 5)
+        self.assertEqual([len(call[0][0]) for call in chunk.call_args_list], [2, 2, 1])
+        self.assertEqual(dt.ArchivedSession.objects.count(), 5)
+
+    def test_disabled_by_default(self):
+        self._make_session(400)
+        self.assertEqual(archive.archive_sessions(), 0)
+        with mock.patch('decisiontree.conf.ARCHIVE_AFTER', 30):
+            self.assertEqual(archive.archive_sessions(), 1)
@@ -0,0 +1,169 @@
+from model_mommy import mommy
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from rapidsms.messages.incoming import IncomingMessage
+
+from decisiontree import compiled
+from decisiontree import models as dt
+
+from .cases import DecisionTreeTestCase
+
+
+class CompiledTreeTest(DecisionTreeTestCase):
+
+    def setUp(self):
+        super(CompiledTreeTest, self).setUp()
+        self.survey = mommy.make('decisiontree.Tree', trigger='food')
+        mommy.make(
+            'decisiontree_multitenancy.TreeLink', linked=self.survey, tenant=self.tenant)
+        self.tag = mommy.make('decisiontree.Tag')
+        self.second_state = mommy.make('decisiontree.TreeState')
+        self.yes = mommy.make('decisiontree.Answer', type='A', answer='yes')
+        self.no = mommy.make('decisiontree.Answer', type='A', answer='no')
+        self.transition1 = mommy.make(
+            'decisiontree.Transition', current_state=self.survey.root_state,
+            answer=self.no, next_state=self.second_state)
+        self.transition1.tags.add(self.tag)
+        self.transition2 = mommy.make(
+            'decisiontree.Transition', current_state=self.survey.root_state,
+            answer=self.yes, next_state=self.second_state)
+        self.transition3 = mommy.make(
+            'decisiontree.Transition', current_state=self.second_state,
+            answer=self.yes, next_state=mommy.make('decisiontree.TreeState'))
+
+    def _send(self, text):
+        msg = IncomingMessage([self.connection], text)
+        self.app.handle(msg)
+        return msg
+
+    def test_reachable_states(self):
+        """All states reachable from the root state are compiled."""
+        tree = compiled.get_tree(self.survey.pk)
+        self.assertEqual(tree.trigger, 'food')
+        self.assertEqual(set(tree.states), set([
+            self.survey.root_state.pk, self.second_state.pk,
+            self.transition3.next_state.pk]))
+
+    def test_transitions(self):
+        """Transitions keep their database order and auto tags."""
+        state = compiled.get_state(self.survey.pk, self.survey.root_state.pk)
+        self.assertEqual([t.id for t in state.transitions],
+                         [self.transition1.pk, self.transition2.pk])
+        self.assertEqual(state.transitions[0].tag_ids, (self.tag.pk,))
+        self.assertEqual(state.transitions[0].next_state_id, self.second_state.pk)
+        self.assertEqual(state.hints, 'yesno')
+
+    def test_invalidated_on_save(self):
+        """Saving a tree component discards compiled trees."""
+        compiled.get_tree(self.survey.pk)
+        message = self.survey.root_state.message
+        message.text = 'What is your favorite food?'
+        message.save()
+        state = compiled.get_state(self.survey.pk, self.survey.root_state.pk)
+        self.assertEqual(state.message_text, 'What is your favorite food?')
+
+    def test_invalidated_on_delete(self):
+        """Deleting a transition discards compiled trees."""
+        compiled.get_tree(self.survey.pk)
+        self.transition2.delete()
+        state = compiled.get_state(self.survey.pk, self.survey.root_state.pk)
+        self.assertEqual([t.id for t in state.transitions], [self.transition1.pk])
+
+    def test_snapshot_saved(self):
+        """The snapshot is saved with the tree and reused by other workers."""
+        compiled.get_tree(self.survey.pk)
+        version = dt.Tree.objects.get(pk=self.survey.pk).version
+        registry = compiled.TreeRegistry()
+        with self.assertNumQueries(1):
+            tree = registry.get_tree(self.survey.pk)
+        self.assertEqual(tree.version, version)
+        self.assertEqual(tree.order, (self.survey.root_state.pk, self.second_state.pk,
+                                      self.transition3.next_state.pk))
+
+    def test_version_checked(self):
+        """Workers recompile a tree only if its version changed."""
+        registry = compiled.TreeRegistry()
+        tree = registry.get_tree(self.survey.pk)
+        compiled.invalidate([])
+        with self.assertNumQueries(1):
+            self.assertIs(registry.get_tree(self.survey.pk), tree)
+        self.transition2.delete()
+        tree = registry.get_tree(self.survey.pk)
+        self.assertEqual(tree.version, dt.Tree.objects.get(pk=self.survey.pk).version)
+        self.assertEqual([t.id for t in tree.states[self.survey.root_state.pk].transitions],
+                         [self.transition1.pk])
+
+    def test_tree_save_keeps_other_snapshots(self):
+        """Saving a tree only marks that tree as changed."""
+        other = mommy.make('decisiontree.Tree', trigger='drink')
+        compiled.get_tree(self.survey.pk)
+        compiled.get_tree(other.pk)
+        self.survey.summary = 'Favorite foods'
+        self.survey.save()
+        self.assertEqual(dt.Tree.objects.get(pk=self.survey.pk).compiled, '')
+        self.assertNotEqual(dt.Tree.objects.get(pk=other.pk).compiled, '')
+
+    def test_component_save_keeps_other_snapshots(self):
+        """Saving part of a tree only marks the trees which use it as changed."""
+        other = mommy.make('decisiontree.Tree', trigger='drink')
+        compiled.get_tree(self.survey.pk)
+        compiled.get_tree(other.pk)
+        self.tag.name = 'hungry'
+        self.tag.save()
+        self.assertEqual(dt.Tree.objects.get(pk=self.survey.pk).compiled, '')
+        self.assertNotEqual(dt.Tree.objects.get(pk=other.pk).compiled, '')
+
+    def test_moved_transition(self):
+        """Moving a transition to another tree marks both trees as changed."""
+        other = mommy.make('decisiontree.Tree', trigger='drink')
+        compiled.get_tree(self.survey.pk)
+        compiled.get_tree(other.pk)
+        self.transition3.current_state = other.root_state
+        self.transition3.save()
+        self.assertEqual(dt.Tree.objects.get(pk=self.survey.pk).compiled, '')
+        self.assertEqual(dt.Tree.objects.get(pk=other.pk).compiled, '')
+        state = compiled.get_state(other.pk, other.root_state.pk)
+        self.assertEqual([t.id for t in state.transitions], [self.transition3.pk])
+
+    def test_find_tree_ids(self):
+        """Trees are found from any state they reach."""
+        other = mommy.make('decisiontree.Tree', root_state=self.second_state)
+        self.assertEqual(compiled.find_tree_ids([self.transition3.next_state.pk]),
+                         [self.survey.pk, other.pk])
+        self.assertEqual(compiled.find_tree_ids([self.survey.root_state.pk]), [self.survey.pk])
+
+    def test_tenant_change_keeps_snapshots(self):
+        """Moving a tree to another tenant rebuilds the trigger index only."""
+        other = mommy.make('multitenancy.Tenant')
+        compiled.get_tree(self.survey.pk)
+        version = dt.Tree.objects.get(pk=self.survey.pk).version
+        self.assertEqual(compiled.find_tree_id('food', self.tenant.pk, True), self.survey.pk)
+        link = self.survey.tenantlink
+        link.tenant = other
+        link.save()
+        self.assertIsNone(compiled.find_tree_id('food', self.tenant.pk, True))
+        self.assertEqual(compiled.find_tree_id('food', other.pk, True), self.survey.pk)
+        survey = dt.Tree.objects.get(pk=self.survey.pk)
+        self.assertEqual(survey.version, version)
+        self.assertNotEqual(survey.compiled, '')
+
+    def test_unreachable_state(self):
+        """A session state which is not reachable from the root is compiled on demand."""
+        orphan = mommy.make('decisiontree.TreeState')
+        state = compiled.get_state(self.survey.pk, orphan.pk)
+        self.assertEqual(state.id, orphan.pk)
+        self.assertEqual(state.transitions, ())
+
+    def test_no_structure_queries(self):
+        """Answering a question does not query the tree structure."""
+        self._send('food')
+        with CaptureQueriesContext(connection) as queries:
+            msg = self._send('yes')
+        self.assertIn(self.second_state.message.text, msg.responses[0]['text'])
+        tables = ['decisiontree_transition"', 'decisiontree_treestate"',
+                  'decisiontree_answer"', 'decisiontree_message"']
+        for query in queries.captured_queries:
+            for table in tables:
+                self.assertNotIn(table, query['sql'])
@@ -0,0 +1,264 @@
+import datetime
+import io
+import shutil
+import tempfile
+import unittest
+
+import mock
+from model_mommy import mommy
+
+from django.test import override_settings
+from django.utils import timezone
+
+from decisiontree import archive
+from decisiontree import exports
+from decisiontree import models as dt
+from decisiontree import tasks
+
+from .cases import DecisionTreeTestCase
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class ExportTestMixin(object):
+
+    def setUp(self):
+        super(ExportTestMixin, self).setUp()
+        self.survey = mommy.make('decisiontree.Tree', trigger='food')
+        self.first = mommy.make(
+            'decisiontree.Transition', current_state=self.survey.root_state,
+            answer=mommy.make('decisiontree.Answer', name='fruit'),
+            next_state=mommy.make('decisiontree.TreeState'))
+        self.second = mommy.make(
+            'decisiontree.Transition', current_state=self.first.next_state,
+            answer=mommy.make('decisiontree.Answer', name='apple'),
+            next_state=mommy.make('decisiontree.TreeState'))
+        self.states = self.survey.get_all_states()
+
+    def _make_session(self, *transitions):
+        session = mommy.make('decisiontree.Session', connection=self.connection,
+                             tree=self.survey, num_tries=0)
+        for i, transition in enumerate(transitions):
+            mommy.make('decisiontree.Entry', session=session, sequence_id=i + 1,
+                       transition=transition)
+        return session
+
+
+class SurveyExportTest(ExportTestMixin, DecisionTreeTestCase):
+
+    def test_rows(self):
+        sessions = [self._make_session(self.first, self.second),
+                    self._make_session(self.first)]
+        rows = list(exports.survey_rows(self.survey, self.states))
+        self.assertEqual(rows[0][:2], ["Person", "Date"])
+        self.assertEqual(rows[0][2:], [state.message for state in self.states])
+        connection = str(self.connection)
+        self.assertEqual(rows[1:], [
+            [connection, sessions[0].start_date, 'fruit', 'apple', ''],
+            [connection, sessions[1].start_date, 'fruit', '', ''],
+        ])
+
+    def test_queries_per_chunk(self):
+        for i in range(5):
+            self._make_session(self.first, self.second)
+        # a query for the sessions and one for their answers per chunk
+        with self.assertNumQueries(6):
+            rows = list(exports.session_rows(self.survey, self.states, chunk_size=2))
+        self.assertEqual(len(rows), 5)
+
+    def test_archived(self):
+        old = self._make_session(self.first, self.second)
+        old.close()
+        self._make_session(self.first)
+        archive.archive(dt.Session.objects.filter(pk=old.pk))
+        rows = list(exports.survey_rows(self.survey, self.states))
+        self.assertEqual(len(rows), 2)
+        rows = list(exports.survey_rows(self.survey, self.states, archived=True))
+        self.assertEqual([row[2:] for row in rows[1:]],
+                         [['fruit', 'apple', ''], ['fruit', '', '']])
+
+    def test_csv_lines(self):
+        date = datetime.datetime(2015, 1, 2)
+        lines = exports.csv_lines([['a', date, 'b,c']])
+        self.assertEqual(list(lines), ['a,2015-01-02 00:00:00,"b,c"\r\n'])
+
+    def test_delta(self):
+        old = self._make_session(self.first)
+        new = self._make_session(self.first, self.second)
+        since = timezone.now() - datetime.timedelta(hours=1)
+        dt.Session.objects.filter(pk=old.pk).update(
+            last_modified=since - datetime.timedelta(minutes=1))
+        dt.Session.objects.filter(pk=new.pk).update(
+            last_modified=since + datetime.timedelta(minutes=1))
+        cursor = exports.get_cursor(self.survey, since)
+        self.assertEqual(cursor, dt.Session.objects.get(pk=new.pk).last_modified)
+        rows = list(exports.survey_rows(self.survey, self.states, since=since, until=cursor))
+        self.assertEqual([row[2:] for row in rows[1:]], [['fruit', 'apple', '']])
+        # nothing changed since the cursor
+        self.assertEqual(exports.get_cursor(self.survey, cursor), cursor)
+        rows = list(exports.survey_rows(self.survey, self.states, since=cursor))
+        self.assertEqual(len(rows), 1)
+
+    def test_cursor_lag(self):
+        """Sessions changed within the lag are left for the next delta."""
+        session = self._make_session(self.first)
+        since = timezone.now() - datetime.timedelta(hours=1)
+        cursor = exports.get_cursor(self.survey, since)
+        self.assertLess(cursor, dt.Session.objects.get(pk=session.pk).last_modified)
+        self.assertLessEqual(cursor, timezone.now() - datetime.timedelta(seconds=60))
+        rows = list(exports.survey_rows(self.survey, self.states, since=since, until=cursor))
+        self.assertEqual(len(rows), 1)
+        rows = list(exports.survey_rows(self.survey, self.states, since=cursor))
+        self.assertEqual(len(rows), 2)
+        # the cursor never goes back
+        since = timezone.now()
+        self.assertEqual(exports.get_cursor(self.survey, since), since)
+
+    def test_closed_session_in_delta(self):
+        session = self._make_session(self.first)
+        cursor = exports.get_cursor(self.survey)
+        dt.Session.objects.filter(pk=session.pk).update(
+            last_modified=cursor + datetime.timedelta(seconds=1))
+        rows = list(exports.survey_rows(self.survey, self.states, since=cursor))
+        self.assertEqual(len(rows), 2)
+
+    def test_cursors(self):
+        cursor = timezone.now()
+        self.assertEqual(exports.parse_cursor(exports.format_cursor(cursor)), cursor)
+        self.assertEqual(exports.format_cursor(None), '')
+        self.assertIsNone(exports.get_cursor(self.survey))
+        with self.assertRaises(ValueError):
+            exports.parse_cursor('yesterday')
+
+
+class ColumnarExportTest(ExportTestMixin, DecisionTreeTestCase):
+
+    def test_records(self):
+        session = self._make_session(self.first, self.second)
+        dt.Session.objects.filter(pk=session.pk).update(state=self.second.next_state)
+        closed = self._make_session(self.first)
+        closed.close()
+        closed = dt.Session.objects.get(pk=closed.pk)
+        records = list(exports.session_records(self.survey, self.states))
+        identity = self.connection.identity
+        self.assertEqual(records, [[
+            (session.pk, identity, session.start_date, None,
+             'fruit', session.entries.get(sequence_id=1).text,
+             'apple', session.entries.get(sequence_id=2).text, None, None),
+            (closed.pk, identity, closed.start_date, closed.last_modified,
+             'fruit', closed.entries.get().text, None, None, None, None),
+        ]])
+
+    def test_archived_records(self):
+        session = self._make_session(self.first)
+        session.close()
+        text = session.entries.get().text
+        archive.archive(dt.Session.objects.filter(pk=session.pk))
+        records = list(exports.session_records(self.survey, self.states, archived=True))
+        self.assertEqual([record[4:] for chunk in records for record in chunk],
+                         [('fruit', text, None, None, None, None)])
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_parquet(self):
+        for i in range(3):
+            self._make_session(self.first, self.second)
+        chunks = exports.parquet_chunks(self.survey, self.states, chunk_size=2)
+        table = pyarrow.parquet.read_table(io.BytesIO(b''.join(chunks)))
+        self.assertEqual(table.num_rows, 3)
+        self.assertEqual(table.column('answer_%d' % self.states[1].pk).to_pylist(),
+                         ['apple'] * 3)
+        self.assertEqual(table.schema.field('end_date').type,
+                         exports.columnar_schema(self.states).field('end_date').type)
+        metadata = pyarrow.parquet.ParquetFile(io.BytesIO(b''.join(
+            exports.parquet_chunks(self.survey, self.states, chunk_size=2)))).metadata
+        self.assertEqual(metadata.num_row_groups, 2)
+
+
+class ExportJobTest(ExportTestMixin, DecisionTreeTestCase):
+
+    def setUp(self):
+        super(ExportJobTest, self).setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_task(self):
+        for i in range(5):
+            self._make_session(self.first)
+        job, created = exports.get_or_create_job(self.survey)
+        self.assertTrue(created)
+        with mock.patch('decisiontree.conf.EXPORT_CHUNK_SIZE', 2):
+            tasks.export_survey(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, dt.ExportJob.DONE)
+        self.assertEqual((job.rows, job.total), (5, 5))
+        self.assertTrue(job.is_available())
+        rows = exports.survey_rows(self.survey, self.states)
+        with job.file.storage.open(job.file.name) as f:
+            self.assertEqual(f.read().decode('utf-8'), ''.join(exports.csv_lines(rows)))
+
+    def test_reused_until_data_changes(self):
+        self._make_session(self.first)
+        job, created = exports.get_or_create_job(self.survey)
+        exports.run_job(job.pk)
+        self.assertEqual(exports.get_or_create_job(self.survey), (job, False))
+        self.assertTrue(exports.get_or_create_job(self.survey, archived=True)[1])
+        self._make_session(self.first)
+        self.assertTrue(exports.get_or_create_job(self.survey)[1])
+
+    def test_key_changes_with_sessions(self):
+        session = self._make_session(self.first)
+        session.state = self.survey.root_state
+        session.save()
+        dt.Session.objects.filter(pk=session.pk).update(
+            last_modified=timezone.now() - datetime.timedelta(minutes=1))
+        key = exports.export_key(self.survey)
+        session.close()
+        closed = exports.export_key(self.survey)
+        self.assertNotEqual(closed, key)
+        mommy.make('decisiontree.ArchivedSession', tree=self.survey, session_id=1)
+        key = exports.export_key(self.survey)
+        # archived before the latest archived session
+        old = mommy.make('decisiontree.ArchivedSession', tree=self.survey, session_id=2)
+        dt.ArchivedSession.objects.filter(pk=old.pk).update(
+            archived=timezone.now() - datetime.timedelta(days=1))
+        self.assertNotEqual(exports.export_key(self.survey), key)
+
+    def test_running_job_reused(self):
+        job, created = exports.get_or_create_job(self.survey)
+        self.assertEqual(exports.get_or_create_job(self.survey), (job, False))
+
+    def test_stalled_job(self):
+        job, created = exports.get_or_create_job(self.survey)
+        stalled = timezone.now() - datetime.timedelta(minutes=31)
+        dt.ExportJob.objects.filter(pk=job.pk).update(updated=stalled)
+        new_job, created = exports.get_or_create_job(self.survey)
+        self.assertTrue(created)
+        job.refresh_from_db()
+        self.assertEqual(job.status, dt.ExportJob.FAILED)
+        # a job which is still making progress is left alone
+        dt.ExportJob.objects.filter(pk=new_job.pk).update(
+            status=dt.ExportJob.RUNNING,
+            updated=timezone.now() - datetime.timedelta(minutes=29))
+        self.assertEqual(exports.get_or_create_job(self.survey), (new_job, False))
+
+    def test_missing_file(self):
+        job, created = exports.get_or_create_job(self.survey)
+        exports.run_job(job.pk)
+        job.refresh_from_db()
+        job.file.delete()
+        self.assertTrue(exports.get_or_create_job(self.survey)[1])
+
+    def test_failed(self):
+        job, created = exports.get_or_create_job(self.survey)
+        with mock.patch('decisiontree.exports.survey_rows', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                exports.run_job(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, dt.ExportJob.FAILED)
+        self.assertTrue(exports.get_or_create_job(self.survey)[1])
@@ -44,6 +44,15 @@ class ResultsTest(DecisionTreeTestCase):
         response = handler.msg.responses[0]['text']
         self.assertEqual(response, 'No summary for "food" survey')
 
+    def test_answer_counts(self):
+        vegetable = mommy.make('decisiontree.Answer', name='squash')
+        for answer, count in ((self.fruit, 3), (vegetable, 1)):
+            mommy.make('decisiontree.StateAnswerStats', tree=self.survey, state=self.state,
+                       answer=answer, count=count)
+        handler = self._send('food')
+        response = handler.msg.responses[0]['text']
+        self.assertEqual(response, 'Results for "food": food: apples 3, squash 1')
+
     def test_summary_response(self):
         self.survey.summary = '10 people like food'
         self.survey.save()
@@ -0,0 +1,49 @@
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from decisiontree import locks
+
+
+class ExclusiveTest(SimpleTestCase):
+
+    def setUp(self):
+        super(ExclusiveTest, self).setUp()
+        cache.clear()
+        self.calls = []
+
+        @locks.exclusive('job')
+        def job(value):
+            self.calls.append(value)
+            return value
+        self.job = job
+
+    def test_runs_when_free(self):
+        self.assertEqual(self.job(1), 1)
+        self.assertEqual(self.job(2), 2)
+        self.assertEqual(self.calls, [1, 2])
+        self.assertEqual(locks.skipped_runs('job'), 0)
+
+    def test_skipped_while_running(self):
+        token = locks.acquire('job')
+        self.assertEqual(self.job(1), None)
+        self.assertEqual(self.job(2), None)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(locks.skipped_runs('job'), 2)
+        locks.release('job', token)
+        self.assertEqual(self.job(3), 3)
+
+    def test_released_on_error(self):
+        @locks.exclusive('job')
+        def failing():
+            raise ValueError()
+        self.assertRaises(ValueError, failing)
+        self.assertEqual(self.job(1), 1)
+
+    def test_expired_lease_is_not_released_by_old_holder(self):
+        token = locks.acquire('job')
+        cache.delete(locks.lock_key('job'))  # expired
+        other = locks.acquire('job')
+        locks.release('job', token)
+        self.assertEqual(locks.acquire('job'), None)
+        locks.release('job', other)
+        self.assertNotEqual(locks.acquire('job'), None)
@@ -0,0 +1,86 @@
+import re
+from collections import namedtuple
+
+from django.test import SimpleTestCase
+
+from decisiontree.matchers import StateMatcher
+
+
+Answer = namedtuple('Answer', ['type', 'answer'])
+Transition = namedtuple('Transition', ['id', 'answer'])
+
+
+class StateMatcherTest(SimpleTestCase):
+
+    def _matcher(self, *answers):
+        transitions = [Transition(index, Answer(*answer))
+                       for index, answer in enumerate(answers)]
+        return StateMatcher(transitions)
+
+    def _match(self, matcher, text, functions=None):
+        transition = matcher.match(text, text, functions or {})
+        return transition.id if transition else None
+
+    def test_exact(self):
+        """Exact answers match ignoring case."""
+        matcher = self._matcher(('A', 'yes'), ('A', 'No'))
+        self.assertEqual(self._match(matcher, 'YES'), 0)
+        self.assertEqual(self._match(matcher, 'no'), 1)
+        self.assertIsNone(self._match(matcher, 'maybe'))
+
+    def test_empty_text(self):
+        """Empty messages never match."""
+        matcher = self._matcher(('R', '.*'))
+        self.assertIsNone(self._match(matcher, ''))
+
+    def test_regex(self):
+        """Regular expressions match from the start of the message."""
+        matcher = self._matcher(('R', r'\d+$'), ('R', 'y(es)?'))
+        self.assertEqual(self._match(matcher, '42'), 0)
+        self.assertEqual(self._match(matcher, 'Yes please'), 1)
+        self.assertIsNone(self._match(matcher, 'say yes'))
+        self.assertIsNotNone(matcher.combined)
+
+    def test_first_match_wins(self):
+        """The first matching transition wins, whatever the answer types."""
+        matcher = self._matcher(('R', '[a-z]+'), ('A', 'yes'), ('R', 'y'))
+        self.assertEqual(self._match(matcher, 'yes'), 0)
+        matcher = self._matcher(('A', 'yes'), ('R', '[a-z]+'))
+        self.assertEqual(self._match(matcher, 'yes'), 0)
+        self.assertEqual(self._match(matcher, 'no'), 1)
+
+    def test_backreference(self):
+        """Patterns that can't be combined are matched on their own."""
+        matcher = self._matcher(('R', r'(\w)\1'), ('R', 'a'))
+        self.assertEqual(matcher.patterns, [(0, r'(\w)\1')])
+        self.assertEqual(self._match(matcher, 'aa'), 0)
+        self.assertEqual(self._match(matcher, 'ab'), 1)
+
+    def test_invalid_pattern(self):
+        """Invalid patterns raise when they are reached."""
+        matcher = self._matcher(('A', 'yes'), ('R', 'a)|(b'))
+        self.assertEqual(self._match(matcher, 'yes'), 0)
+        with self.assertRaises(re.error):
+            self._match(matcher, 'b')
+
+    def test_custom_called_only_before_best_match(self):
+        """Custom functions only run when they precede the best static match."""
+        calls = []
+
+        def custom(message):
+            calls.append(message)
+            return message == 'magic'
+
+        functions = {'magic': custom}
+        matcher = self._matcher(('A', 'yes'), ('C', 'magic'), ('R', '.*'))
+        self.assertEqual(self._match(matcher, 'yes', functions), 0)
+        self.assertEqual(calls, [])
+        self.assertEqual(self._match(matcher, 'magic', functions), 1)
+        self.assertEqual(self._match(matcher, 'other', functions), 2)
+        self.assertEqual(calls, ['magic', 'other'])
+
+    def test_missing_custom_function(self):
+        """Unregistered custom answers raise an error when reached."""
+        matcher = self._matcher(('C', 'unknown'))
+        with self.assertRaises(Exception):
+            self._match(matcher, 'text')
@@ -1,6 +1,12 @@
+import json
+
 from model_mommy import mommy
 
+from django.core.management import call_command
+from django.utils.six import StringIO
+
 from decisiontree import models
+from decisiontree.multitenancy import models as link_models
 
 from .cases import DecisionTreeTestCase
 
@@ -43,6 +49,15 @@ class TestSessionModel(DecisionTreeTestCase):
         self.assertTrue(self.session.is_closed())
         self.assertFalse(self.session.is_open())
 
+    def test_active(self):
+        """The active column follows is_open() whenever a session is saved."""
+        self.session.canceled = False
+        self.session.state = mommy.make('decisiontree.TreeState')
+        self.session.save(update_fields=['state', 'canceled'])
+        self.assertTrue(models.Session.objects.get(pk=self.session.pk).active)
+        self.session.close()
+        self.assertFalse(models.Session.objects.get(pk=self.session.pk).active)
+
     def test_manager_open(self):
         """Session is in open() queryset if it has a state and is not canceled."""
         self.session.canceled = False
@@ -94,3 +109,160 @@ class TestSessionModel(DecisionTreeTestCase):
         closed_qs = models.Session.objects.closed()
         self.assertEqual(len(closed_qs), 1)
         self.assertTrue(self.session in closed_qs)
+
+
+class TestEntryModel(DecisionTreeTestCase):
+
+    def test_tree_from_session(self):
+        """Entries saved without a tree get their session's tree."""
+        session = mommy.make('decisiontree.Session', connection=self.connection)
+        entry = mommy.make('decisiontree.Entry', session=session)
+        self.assertEqual(models.Entry.objects.get(pk=entry.pk).tree_id, session.tree_id)
+
+
+class TestTagNotificationModel(DecisionTreeTestCase):
+
+    def setUp(self):
+        super(TestTagNotificationModel, self).setUp()
+        self.user = mommy.make('auth.User')
+        self.tag = mommy.make('decisiontree.Tag')
+        mommy.make('decisiontree_multitenancy.TagLink', linked=self.tag, tenant=self.tenant)
+        self.tag.recipients.add(self.user)
+        session = mommy.make('decisiontree.Session', connection=self.connection)
+        self.entry = mommy.make('decisiontree.Entry', session=session)
+        self.entry.tags.add(self.tag)
+
+    def test_create_from_entry(self):
+        """Recipients of the entry's tags are notified once."""
+        models.TagNotification.create_from_entry(self.entry)
+        models.TagNotification.create_from_entry(self.entry)
+        notification = models.TagNotification.objects.get()
+        self.assertEqual(notification.user, self.user)
+        self.assertEqual(notification.tag, self.tag)
+        self.assertFalse(notification.sent)
+        self.assertIsNotNone(notification.date_added)
+
+    def test_create_in_bulk(self):
+        """Notifications are linked to their tags' tenants in bulk."""
+        users = [self.user, mommy.make('auth.User'), mommy.make('auth.User')]
+        # insert notifications, load their ids, load tag tenants, insert links
+        with self.assertNumQueries(4):
+            models.TagNotification.create_in_bulk(
+                (self.entry.pk, self.tag.pk, user.pk) for user in users)
+        links = link_models.TagNotificationLink.all_tenants.all()
+        self.assertEqual(sorted(link.linked.user_id for link in links),
+                         sorted(user.pk for user in users))
+        self.assertEqual(set(link.tenant_id for link in links), set([self.tenant.pk]))
+
+
+class TestTreeModel(DecisionTreeTestCase):
+
+    def setUp(self):
+        super(TestTreeModel, self).setUp()
+        self.tree = mommy.make('decisiontree.Tree')
+        self.states = dict((name, mommy.make('decisiontree.TreeState', name=name))
+                           for name in 'bcdef')
+        self.states['a'] = self.tree.root_state
+        self._link('a', 'b')
+        self._link('a', 'c')
+        self._link('b', 'd')
+        self._link('c', 'd')
+        self._link('d', 'b')  # loop
+        self._link('c', 'e')
+        mommy.make('decisiontree.TreeState', name='unreachable')
+
+    def _link(self, current, next):
+        mommy.make('decisiontree.Transition', current_state=self.states[current],
+                   next_state=self.states[next])
+
+    def test_get_all_states(self):
+        """States are listed depth first, in transition order."""
+        states = self.tree.get_all_states()
+        self.assertEqual([state.pk for state in states],
+                         [self.states[name].pk for name in 'abdce'])
+
+    def test_get_all_states_queries(self):
+        """The snapshot is read from the tree's row, plus one query for the states."""
+        tree = models.Tree.objects.select_related('root_state__message').get(pk=self.tree.pk)
+        tree.get_all_states()  # builds the snapshot
+        with self.assertNumQueries(2):
+            states = tree.get_all_states()
+        with self.assertNumQueries(0):
+            [state.message.text for state in states]
+
+    def test_add_all_unique_children_skips_added(self):
+        added = [self.states['b']]
+        self.states['a'].add_all_unique_children(added)
+        self.assertEqual([state.pk for state in added],
+                         [self.states[name].pk for name in 'bcde'])
+
+    def test_find_loop(self):
+        loop = self.tree.find_loop()
+        self.assertEqual([state.pk for state in loop],
+                         [self.states[name].pk for name in 'bd'])
+        self.assertTrue(self.tree.has_loops())
+
+    def test_no_loop(self):
+        models.Transition.objects.filter(current_state=self.states['d'],
+                                         next_state=self.states['b']).delete()
+        with self.assertNumQueries(3):
+            self.assertEqual(self.tree.find_loop(), [])
+        self.assertFalse(self.tree.has_loops())
+        self.assertFalse(self.states['c'].has_loops_below())
+
+    def test_path_has_loops(self):
+        """Reaching any state of the path again is a loop."""
+        models.Transition.objects.filter(current_state=self.states['d'],
+                                         next_state=self.states['b']).delete()
+        self._link('e', 'b')
+        self.assertTrue(models.TreeState.path_has_loops([self.states['b'], self.states['c']]))
+        self.assertEqual(self.states['c'].find_loop_below(), [])
+
+
+class TestStateAnswerStatsModel(DecisionTreeTestCase):
+
+    def setUp(self):
+        super(TestStateAnswerStatsModel, self).setUp()
+        self.survey = mommy.make('decisiontree.Tree')
+        self.state = self.survey.root_state
+        self.transition = mommy.make('decisiontree.Transition', current_state=self.state)
+        self.key = (self.survey.pk, self.state.pk, self.transition.answer_id)
+
+    def test_add(self):
+        models.StateAnswerStats.add([self.key, self.key])
+        # one update per answer once its row exists
+        with self.assertNumQueries(1):
+            models.StateAnswerStats.add([self.key])
+        stats = models.StateAnswerStats.objects.get()
+        self.assertEqual((stats.tree, stats.state, stats.answer, stats.count),
+                         (self.survey, self.state, self.transition.answer, 3))
+
+    def test_rebuild(self):
+        session = mommy.make('decisiontree.Session', connection=self.connection,
+                             tree=self.survey)
+        mommy.make('decisiontree.Entry', session=session, transition=self.transition)
+        entries = [{'transition_id': self.transition.pk, 'state_id': self.state.pk}]
+        mommy.make('decisiontree.ArchivedSession', connection=self.connection,
+                   tree=self.survey, data=json.dumps({'entries': entries}))
+        other = mommy.make('decisiontree.Tree')
+        models.StateAnswerStats.add(
+            [self.key, (other.pk, self.state.pk, self.transition.answer_id)])
+        self.assertEqual(models.StateAnswerStats.rebuild([self.survey.pk]), 2)
+        stats = models.StateAnswerStats.objects.order_by('tree')
+        self.assertEqual([(s.tree_id, s.count) for s in stats],
+                         [(self.survey.pk, 2), (other.pk, 1)])
+
+    def test_transition_deleted(self):
+        other = mommy.make('decisiontree.Transition', current_state=self.state)
+        models.StateAnswerStats.add(
+            [self.key, (self.survey.pk, self.state.pk, other.answer_id)])
+        self.transition.delete()
+        stats = models.StateAnswerStats.objects.get()
+        self.assertEqual(stats.answer_id, other.answer_id)
+
+    def test_rebuild_command(self):
+        models.StateAnswerStats.add([self.key])
+        output = StringIO()
+        call_command('rebuild_answer_stats', stdout=output)
+        self.assertEqual(output.getvalue(), "Counted 0 answers.\n")
+        self.assertFalse(models.StateAnswerStats.objects.exists())
@@ -0,0 +1,90 @@
+import datetime
+
+from model_mommy import mommy
+
+from django.utils import timezone
+
+from decisiontree import models as dt
+from decisiontree import reports
+
+from .cases import DecisionTreeTestCase
+
+
+class SummarizeTest(DecisionTreeTestCase):
+
+    def test_numbers(self):
+        stats = reports.summarize([('3', 1), ('1', 2), ('10', 1)])
+        self.assertEqual(stats, {'mean': 3.75, 'median': 2.0, 'mode': [1]})
+
+    def test_odd_count(self):
+        stats = reports.summarize([('3', 1), ('1', 2)])
+        self.assertEqual(stats['median'], 1)
+
+    def test_text(self):
+        stats = reports.summarize([('b', 2), ('a', 1), ('c', 2)])
+        self.assertEqual(stats, {'mean': 'n/a', 'median': 'b', 'mode': ['b', 'c']})
+        self.assertEqual(reports.summarize([('b', 1), ('a', 1)])['median'], 'n/a')
+
+
+class SurveyReportTest(DecisionTreeTestCase):
+
+    def setUp(self):
+        super(SurveyReportTest, self).setUp()
+        self.survey = mommy.make('decisiontree.Tree', trigger='food')
+        self.yes = mommy.make(
+            'decisiontree.Transition', current_state=self.survey.root_state,
+            answer=mommy.make('decisiontree.Answer', name='yes'),
+            next_state=mommy.make('decisiontree.TreeState'))
+        self.no = mommy.make(
+            'decisiontree.Transition', current_state=self.survey.root_state,
+            answer=mommy.make('decisiontree.Answer', name='no'))
+        self.states = self.survey.get_all_states()
+
+    def _make_session(self, minutes, *answers):
+        session = mommy.make('decisiontree.Session', connection=self.connection,
+                             tree=self.survey, num_tries=0)
+        start = timezone.now() - datetime.timedelta(minutes=minutes)
+        dt.Session.objects.filter(pk=session.pk).update(start_date=start)
+        for i, (transition, text) in enumerate(answers):
+            mommy.make('decisiontree.Entry', session=session, sequence_id=i + 1,
+                       transition=transition, text=text)
+        return session
+
+    def test_answer_stats(self):
+        self._make_session(1, (self.yes, '1'))
+        self._make_session(2, (self.yes, '3'))
+        self._make_session(3, (self.no, '2'))
+        dt.StateAnswerStats.rebuild()
+        with self.assertNumQueries(2):
+            stats = reports.answer_stats(self.survey)
+        stat = stats[self.survey.root_state.pk]
+        self.assertEqual(list(stat['answers'].items()), [('no', 1), ('yes', 2)])
+        self.assertEqual(stat['total'], 3)
+        self.assertEqual(stat['mean'], 2)
+        self.assertEqual(list(stats), [self.survey.root_state.pk])
+
+    def test_pages(self):
+        sessions = [self._make_session(i, (self.yes, 'y')) for i in range(5)]
+        # sessions with the same start date are ordered by id
+        dt.Session.objects.filter(pk=sessions[2].pk).update(
+            start_date=dt.Session.objects.get(pk=sessions[1].pk).start_date)
+        with self.assertNumQueries(3):
+            page, more = reports.session_page(self.survey, self.states, size=2)
+        self.assertEqual(page, [sessions[0], sessions[2]])
+        self.assertTrue(more)
+        page, more = reports.session_page(self.survey, self.states, page[-1], size=2)
+        self.assertEqual(page, [sessions[1], sessions[3]])
+        page, more = reports.session_page(self.survey, self.states, page[-1], size=2)
+        self.assertEqual(page, [sessions[4]])
+        self.assertFalse(more)
+
+    def test_ordered_states(self):
+        session = self._make_session(1, (self.no, 'n'), (self.yes, 'y'))
+        tag = mommy.make('decisiontree.Tag')
+        entry = session.entries.get(sequence_id=2)
+        entry.tags.add(tag)
+        page, more = reports.session_page(self.survey, self.states)
+        self.assertEqual(page[0].ordered_states[0], (self.survey.root_state, entry))
+        self.assertEqual([pair[1] for pair in page[0].ordered_states[1:]],
+                         [None] * (len(self.states) - 1))
+        self.assertEqual(page[0].ordered_states[0][1].cached_tags, [tag])
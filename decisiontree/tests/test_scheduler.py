@@ -0,0 +1,102 @@
+import datetime
+
+from model_mommy import mommy
+
+from django.utils import timezone
+
+from rapidsms.messages.incoming import IncomingMessage
+
+from decisiontree import conf
+from decisiontree.scheduler import TimeoutScheduler
+
+from .cases import DecisionTreeTestCase
+
+
+class TestClock(object):
+
+    def __init__(self):
+        self.now = timezone.now().replace(microsecond=0)
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += datetime.timedelta(seconds=seconds)
+
+
+class TimeoutSchedulerTest(DecisionTreeTestCase):
+
+    def setUp(self):
+        super(TimeoutSchedulerTest, self).setUp()
+        self.clock = TestClock()
+        self.app.scheduler = TimeoutScheduler(clock=self.clock)
+        self.survey = mommy.make('decisiontree.Tree', trigger='food')
+        mommy.make(
+            'decisiontree_multitenancy.TreeLink', linked=self.survey, tenant=self.tenant)
+        self.transition = mommy.make(
+            'decisiontree.Transition', current_state=self.survey.root_state,
+            answer=mommy.make('decisiontree.Answer', type='A'),
+            next_state=mommy.make('decisiontree.TreeState', timeout=30))
+        mommy.make('decisiontree.Transition', current_state=self.transition.next_state)
+
+    def _send(self, text):
+        msg = IncomingMessage([self.connection], text)
+        self.app.handle(msg)
+        return msg
+
+    def _session(self):
+        return self.connection.session_set.get()
+
+    def _seconds_due(self):
+        return (self._session().timeout_at - self.clock.now).total_seconds()
+
+    def test_due_after_default_timeout(self):
+        self._send('food')
+        self.assertEqual(self._seconds_due(), conf.TIMEOUT)
+
+    def test_due_after_state_timeout(self):
+        self._send('food')
+        self.clock.advance(10)
+        self._send(self.transition.answer.answer)
+        self.assertEqual(self._seconds_due(), 30)
+
+    def test_invalid_answer_asks_again(self):
+        self._send('food')
+        self.clock.advance(10)
+        self._send('bad-answer')
+        self.assertEqual(self._seconds_due(), conf.TIMEOUT)
+
+    def test_handle_many(self):
+        self._send('food')
+        self.clock.advance(10)
+        self.app.handle_many([IncomingMessage([self.connection],
+                                              self.transition.answer.answer)])
+        self.assertEqual(self._seconds_due(), 30)
+
+    def test_closed_session_is_not_due(self):
+        self._send('food')
+        self._send('end')
+        self.assertEqual(self._session().timeout_at, None)
+
+    def test_due(self):
+        self._send('food')
+        self.assertEqual(list(self.app.scheduler.due()), [])
+        self.clock.advance(conf.TIMEOUT)
+        self.assertEqual(list(self.app.scheduler.due()), [self._session()])
+
+    def test_run_in_order_of_due_time(self):
+        self._send('food')
+        other = mommy.make('rapidsms.Connection', backend=self.backend)
+        self.app.handle(IncomingMessage([other], 'food'))
+        self.clock.advance(10)
+        self._send(self.transition.answer.answer)
+        self.clock.advance(60)
+        fired = []
+        scanned, timed_out = self.app.scheduler.run(
+            lambda sessions: fired.extend(s.connection for s in sessions) or len(sessions))
+        self.assertEqual((scanned, timed_out), (1, 1))
+        self.assertEqual(fired, [self.connection])
+        self.clock.advance(conf.TIMEOUT)
+        fired = []
+        self.app.scheduler.run(lambda sessions: fired.extend(s.connection for s in sessions) or 0)
+        self.assertEqual(fired, [self.connection, other])
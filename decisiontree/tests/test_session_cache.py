@@ -0,0 +1,115 @@
+import mock
+from model_mommy import mommy
+
+from rapidsms.messages.incoming import IncomingMessage
+
+from decisiontree import models
+from decisiontree import session_cache
+
+from .cases import DecisionTreeTestCase
+
+
+class SessionCacheTest(DecisionTreeTestCase):
+
+    def setUp(self):
+        super(SessionCacheTest, self).setUp()
+        self.survey = mommy.make('decisiontree.Tree', trigger='food')
+        mommy.make(
+            'decisiontree_multitenancy.TreeLink', linked=self.survey, tenant=self.tenant)
+        self.answer = mommy.make('decisiontree.Answer', type='A', answer='yes')
+        self.next_state = mommy.make('decisiontree.TreeState')
+        self.transition = mommy.make(
+            'decisiontree.Transition', current_state=self.survey.root_state,
+            answer=self.answer, next_state=self.next_state)
+        mommy.make(
+            'decisiontree.Transition', current_state=self.next_state,
+            answer=self.answer, next_state=mommy.make('decisiontree.TreeState'))
+
+    def _send(self, text):
+        msg = IncomingMessage([self.connection], text)
+        self.app.handle(msg)
+        return msg
+
+    def test_no_session(self):
+        """Connections without an open session are remembered."""
+        self.assertIsNone(session_cache.get_pointer(self.connection))
+        with self.assertNumQueries(0):
+            self.assertIsNone(session_cache.get_pointer(self.connection))
+
+    def test_no_session_expires(self):
+        """Connections without an open session are remembered briefly."""
+        with mock.patch.object(session_cache, 'get_cache') as get_cache:
+            get_cache.return_value.get.return_value = None
+            session_cache.get_pointer(self.connection)
+        get_cache.return_value.add.assert_called_once_with(
+            session_cache.cache_key(self.connection.pk), (), 60)
+
+    def test_pointer_set_during_miss(self):
+        """A pointer set while a miss is looked up is not replaced."""
+        self._send('food')
+        pointer = session_cache.get_pointer(self.connection)
+        session_cache.clear_pointer(self.connection.pk)
+        models.Session.objects.update(canceled=True)
+
+        def set_pointer(*args, **kwargs):
+            # the session is started after the query but before the add
+            session_cache.set_pointer(pointer)
+            return []
+
+        with mock.patch('decisiontree.models.SessionQuerySet.first',
+                        side_effect=set_pointer):
+            self.assertEqual(session_cache.get_pointer(self.connection), pointer)
+        self.assertEqual(session_cache.get_pointer(self.connection), pointer)
+
+    def test_start_tree(self):
+        """Starting a tree points the connection at the new session."""
+        self._send('food')
+        session = self.connection.session_set.get()
+        with self.assertNumQueries(0):
+            pointer = session_cache.get_pointer(self.connection)
+        self.assertEqual(pointer, session_cache.pointer_for(session))
+
+    def test_state_advance(self):
+        """Accepted answers move the cached pointer along."""
+        self._send('food')
+        self._send('yes')
+        pointer = session_cache.get_pointer(self.connection)
+        self.assertEqual(pointer.state_id, self.next_state.pk)
+        session = self.connection.session_set.get()
+        self.assertEqual(session.state_id, self.next_state.pk)
+        self.assertEqual(session.num_tries, 0)
+
+    def test_invalid_answer(self):
+        """Invalid answers update the number of tries."""
+        self._send('food')
+        self._send('no')
+        pointer = session_cache.get_pointer(self.connection)
+        self.assertEqual(pointer.num_tries, 1)
+        self.assertEqual(self.connection.session_set.get().num_tries, 1)
+
+    def test_close(self):
+        """Closing a session discards the pointer."""
+        self._send('food')
+        self.connection.session_set.get().cancel()
+        self.assertIsNone(session_cache.get_pointer(self.connection))
+        msg = self._send('yes')
+        self.assertEqual(msg.responses, [])
+
+    def test_deleted_state(self):
+        """Pointers to a state which no longer exists are discarded."""
+        self._send('food')
+        pointer = session_cache.get_pointer(self.connection)
+        session_cache.set_pointer(pointer._replace(state_id=self.next_state.pk + 100))
+        self._send('yes')
+        self.assertEqual(models.Entry.objects.count(), 1)
+        self.assertEqual(session_cache.get_pointer(self.connection).state_id,
+                         self.next_state.pk)
+
+    def test_stale_pointer(self):
+        """Sessions changed without signals are detected when answering."""
+        self._send('food')
+        models.Session.objects.update(canceled=True)
+        msg = self._send('yes')
+        self.assertEqual(msg.responses, [])
+        self.assertEqual(models.Entry.objects.count(), 0)
+        self.assertIsNone(session_cache.get_pointer(self.connection))
@@ -0,0 +1,141 @@
+import datetime
+import smtplib
+
+import mock
+from model_mommy import mommy
+
+from django.conf import settings
+from django.core import mail
+from django.utils import timezone
+
+from decisiontree import locks
+from decisiontree import tasks
+from decisiontree import models as dt
+from decisiontree.scheduler import TimeoutScheduler
+
+from .cases import DecisionTreeTestCase
+
+
+class SessionTimeoutTest(DecisionTreeTestCase):
+
+    def setUp(self):
+        super(SessionTimeoutTest, self).setUp()
+        self.survey = mommy.make('decisiontree.Tree', trigger='food')
+        self.app = mock.Mock()
+        self.app.scheduler = TimeoutScheduler()
+        self.app.timeout_many.side_effect = len
+        router = mock.Mock()
+        router.get_app.return_value = self.app
+        patcher = mock.patch('decisiontree.tasks.get_router', return_value=router)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _make_session(self, overdue, **kwargs):
+        timeout_at = timezone.now() - datetime.timedelta(seconds=overdue)
+        return mommy.make('decisiontree.Session', connection=self.connection,
+                          tree=self.survey, state=self.survey.root_state,
+                          num_tries=0, timeout_at=timeout_at, **kwargs)
+
+    def test_only_due_sessions_are_loaded(self):
+        due = self._make_session(60)
+        self._make_session(-60)
+        self._make_session(60, canceled=True)
+        result = tasks.check_for_session_timeout()
+        self.assertEqual(result, {'scanned': 1, 'timed_out': 1})
+        self.app.timeout_many.assert_called_once_with([due])
+
+    def test_scanned_and_timed_out_counts(self):
+        for i in range(3):
+            self._make_session(60)
+        self.app.timeout_many.side_effect = lambda sessions: len(sessions) - 1
+        result = tasks.check_for_session_timeout()
+        self.assertEqual(result, {'scanned': 3, 'timed_out': 2})
+
+    def test_chunks(self):
+        sessions = [self._make_session(60 - i) for i in range(5)]
+        with mock.patch('decisiontree.conf.TIMEOUT_CHUNK_SIZE', 2):
+            result = tasks.check_for_session_timeout()
+        self.assertEqual(result, {'scanned': 5, 'timed_out': 5})
+        self.assertEqual([call[0][0] for call in self.app.timeout_many.call_args_list],
+                         [sessions[:2], sessions[2:4], sessions[4:]])
+
+
+@mock.patch('decisiontree.tasks.render_to_string', return_value='digest')
+class StatusUpdateTest(DecisionTreeTestCase):
+
+    def setUp(self):
+        super(StatusUpdateTest, self).setUp()
+        self.users = [mommy.make(settings.AUTH_USER_MODEL, email='%s@a.com' % name)
+                      for name in ('a', 'b')]
+        tag = self._make_tag()
+        for user in self.users:
+            for i in range(2):
+                self._notify(tag, user)
+
+    def _make_tag(self):
+        tag = mommy.make('decisiontree.Tag')
+        mommy.make('decisiontree_multitenancy.TagLink', linked=tag, tenant=self.tenant)
+        return tag
+
+    def _notify(self, tag, user):
+        session = mommy.make('decisiontree.Session', connection=self.connection)
+        mommy.make('decisiontree.TagNotification', tag=tag, user=user,
+                   entry=mommy.make('decisiontree.Entry', session=session),
+                   date_added=datetime.datetime.now())
+
+    def test_one_digest_per_user(self, render_to_string):
+        # one query for the notifications, one update per user
+        with self.assertNumQueries(3):
+            tasks.status_update()
+        self.assertEqual([m.to for m in mail.outbox], [['a@a.com'], ['b@a.com']])
+        self.assertFalse(dt.TagNotification.objects.filter(sent=False).exists())
+        self.assertFalse(dt.TagNotification.objects.filter(date_sent=None).exists())
+
+    def test_single_connection(self, render_to_string):
+        with mock.patch('decisiontree.tasks.get_connection',
+                        wraps=tasks.get_connection) as get_connection:
+            tasks.status_update()
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_failed_digest_is_not_marked_sent(self, render_to_string):
+        connection = mock.Mock()
+        connection.send_messages.side_effect = [smtplib.SMTPException(), 1]
+        with mock.patch('decisiontree.tasks.get_connection', return_value=connection):
+            summary = tasks.status_update()
+        self.assertEqual(summary, {'sent': 1, 'failed': 1, 'notifications': 2})
+        unsent = dt.TagNotification.objects.filter(sent=False)
+        self.assertEqual(set(unsent.values_list('user__email', flat=True)), set(['a@a.com']))
+        self.assertEqual(unsent.count(), 2)
+        connection.close.assert_called_once_with()
+
+    @mock.patch('decisiontree.conf.DIGEST_WORKERS', 3)
+    def test_worker_pool(self, render_to_string):
+        tag = self._make_tag()
+        for i in range(8):
+            user = mommy.make(settings.AUTH_USER_MODEL, email='user%d@a.com' % i)
+            self._notify(tag, user)
+        # the workers don't use the database
+        with self.assertNumQueries(11):
+            summary = tasks.status_update()
+        self.assertEqual(summary, {'sent': 10, 'failed': 0, 'notifications': 12})
+        self.assertEqual(len(mail.outbox), 10)
+        self.assertFalse(dt.TagNotification.objects.filter(sent=False).exists())
+
+    @mock.patch('decisiontree.conf.DIGEST_WORKERS', 2)
+    def test_worker_pool_failures(self, render_to_string):
+        connection = mock.Mock()
+        connection.send_messages.side_effect = smtplib.SMTPException()
+        with mock.patch('decisiontree.tasks.get_connection', return_value=connection):
+            summary = tasks.status_update()
+        self.assertEqual(summary, {'sent': 0, 'failed': 2, 'notifications': 0})
+        self.assertEqual(dt.TagNotification.objects.filter(sent=False).count(), 4)
+        self.assertTrue(connection.close.called)
+
+    def test_skipped_while_running(self, render_to_string):
+        token = locks.acquire('status_update')
+        self.assertEqual(tasks.status_update(), None)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(locks.skipped_runs('status_update'), 1)
+        locks.release('status_update', token)
+        self.assertEqual(tasks.status_update()['sent'], 2)
@@ -53,3 +53,29 @@ class TestGetSurvey(DecisionTreeTestCase):
         survey = utils.get_survey(self.survey.trigger, self.connection)
         self.assertTrue(multitenancy_enabled.call_count, 1)
         self.assertEqual(survey.pk, self.survey.pk)
+
+    def test_case_insensitive(self, multitenancy_enabled):
+        """get_survey should match triggers regardless of case."""
+        multitenancy_enabled.return_value = False
+        survey = utils.get_survey(self.survey.trigger.upper(), self.connection)
+        self.assertEqual(survey.pk, self.survey.pk)
+
+    def test_non_trigger_no_queries(self, multitenancy_enabled):
+        """Messages which are not triggers are rejected without a query."""
+        for enabled in (False, True):
+            multitenancy_enabled.return_value = enabled
+            utils.get_survey(self.survey.trigger, self.connection)
+            with self.assertNumQueries(0):
+                survey = utils.get_survey('asdf', self.connection)
+            self.assertIsNone(survey)
+
+    def test_trigger_changed(self, multitenancy_enabled):
+        """The trigger index is rebuilt when a survey is saved."""
+        multitenancy_enabled.return_value = False
+        utils.get_survey(self.survey.trigger, self.connection)
+        old_trigger = self.survey.trigger
+        self.survey.trigger = 'new-trigger'
+        self.survey.save()
+        self.assertIsNone(utils.get_survey(old_trigger, self.connection))
+        survey = utils.get_survey('new-trigger', self.connection)
+        self.assertEqual(survey.pk, self.survey.pk)
@@ -1,5 +1,7 @@
+import mock
 from model_mommy import mommy
 
+from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
 
 from decisiontree.multitenancy import models as link_models
@@ -120,3 +122,33 @@ class TestSurveySessionClose(DecisionTreeTestCase):
         self.session = models.Session.objects.get(pk=self.session.pk)
         self.assertTrue(self.session.is_closed())
         self.assertFalse(self.session.is_open())
+
+
+class TestSurveyExport(DecisionTreeTestCase):
+    url_name = 'export_tree'
+
+    def setUp(self):
+        super(TestSurveyExport, self).setUp()
+        self.user = mommy.make('auth.User', is_superuser=True)
+        self.make_tenant_manager(self.user)
+        self.login_user(self.user)
+        self.survey = mommy.make('decisiontree.Tree', trigger='food')
+        mommy.make(link_models.TreeLink, linked=self.survey, tenant=self.tenant)
+
+    def get_url(self, **kwargs):
+        kwargs.setdefault('group_slug', self.tenant.group.slug)
+        kwargs.setdefault('tenant_slug', self.tenant.slug)
+        kwargs.setdefault('pk', self.survey.pk)
+        return reverse(self.url_name, kwargs=kwargs)
+
+    def test_csv(self):
+        response = self.client.get(self.get_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['content-type'], 'application/ms-excel')
+
+    def test_parquet_unavailable(self):
+        """Parquet exports without pyarrow are a bad request, not an error."""
+        with mock.patch('decisiontree.exports._import_pyarrow',
+                        side_effect=ImproperlyConfigured):
+            response = self.client.get(self.get_url(), {'format': 'parquet'})
+        self.assertEqual(response.status_code, 400)
@@ -25,6 +25,9 @@ urlpatterns = [
     url(r'^data/export/(?P<pk>\d+)/$',
         views.SurveyExport.as_view(),
         name='export_tree'),
+    url(r'^data/export/(?P<pk>\d+)/jobs/(?P<job_id>\d+)/$',
+        views.SurveyExportJob.as_view(),
+        name='export_job'),
     url(r'^delete/(?P<pk>\d+)/$',
         views.SurveyDelete.as_view(),
         name='delete_tree'),
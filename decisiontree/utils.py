@@ -1,16 +1,26 @@
 from django.utils.encoding import force_text
 
+from . import compiled
 from .models import Tree
 
 
 def get_survey(trigger, connection):
-    """Returns a survey only if it matches the connection's tenant."""
+    """Returns a survey only if it matches the connection's tenant.
+
+    Triggers are looked up in an in-process index, so that messages which are
+    not triggers (i.e., most of them) are rejected without a query.
+    """
     from decisiontree.multitenancy.utils import multitenancy_enabled
-    queryset = Tree.objects.filter(trigger__iexact=trigger)
-    if multitenancy_enabled():
-        tenant = connection.backend.tenantlink.tenant
-        queryset = queryset.filter(tenantlink__tenant=tenant)
-    return queryset.first()
+    if not trigger:
+        return None
+    multitenancy = multitenancy_enabled()
+    tenant_id = None
+    if multitenancy:
+        tenant_id = compiled.get_backend_tenant_id(connection.backend_id)
+    tree_id = compiled.find_tree_id(trigger, tenant_id, multitenancy)
+    if tree_id is None:
+        return None
+    return Tree.objects.filter(pk=tree_id).first()
 
 
 def parse_tags(tagstring):
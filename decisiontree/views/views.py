@@ -1,13 +1,16 @@
-import csv
-from io import StringIO
-
-from django.db.models import Count
-from django.http import HttpResponse
-from django.shortcuts import redirect
-from collections import OrderedDict
-
+from django.contrib import messages
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum
+from django.http import (FileResponse, Http404, HttpResponseBadRequest, JsonResponse,
+                         StreamingHttpResponse)
+from django.shortcuts import get_object_or_404, redirect
+
+from .. import exports
 from .. import forms
 from .. import models
+from .. import reports
+from .. import tasks
+from ..multitenancy.utils import tenancy_reverse
 from . import base
 
 
@@ -138,7 +141,10 @@ class SurveyList(base.TreeListView):
     template_name = 'tree/surveys/list.html'
 
     def get_queryset(self):
-        return super(SurveyList, self).get_queryset().annotate(count=Count('sessions'))
+        answers = models.StateAnswerStats.objects.filter(tree=OuterRef('pk')).order_by()
+        answers = answers.values('tree').annotate(total=Sum('count')).values('total')
+        queryset = super(SurveyList, self).get_queryset().annotate(count=Count('sessions'))
+        return queryset.annotate(answers=Subquery(answers, output_field=IntegerField()))
 
 
 class SurveyExport(base.TreeDetailView):
@@ -146,103 +152,98 @@ class SurveyExport(base.TreeDetailView):
 
     def get(self, request, *args, **kwargs):
         tree = self.get_object()
-        if tree.has_loops():
+        loop = tree.find_loop()
+        if loop:
+            names = ' -> '.join(state.name for state in loop + loop[:1])
+            messages.error(request, "Surveys with loops can't be exported: %s" % names)
             return redirect('list-surveys')
+        archived = bool(request.GET.get('archived'))
+        since = request.GET.get('since')
+        if since:
+            try:
+                since = exports.parse_cursor(since)
+            except ValueError:
+                return HttpResponseBadRequest("Invalid cursor.")
+        else:
+            since = None
+        parquet = request.GET.get('format') == 'parquet'
+        if request.GET.get('background') and since is None and not parquet:
+            # write the export in a task, or reuse one already written
+            job, created = exports.get_or_create_job(tree, archived)
+            if created:
+                tasks.export_survey.delay(job.pk)
+            return redirect(tenancy_reverse(request, 'export_job', pk=tree.pk, job_id=job.pk))
         all_states = tree.get_all_states()
-        output = StringIO()
-        w = csv.writer(output)
-        headings = ["Person", "Date"]
-        headings.extend([state.message for state in all_states])
-        w.writerow(headings)
-        sessions = models.Session.objects.filter(tree=tree)
-        for session in sessions:
-            values = [str(session.connection), session.start_date]
-            transitions = map((lambda x: x.transition), session.entries.all())
-            states_w_transitions = {}
-            for transition in transitions:
-                states_w_transitions[transition.current_state] = transition
-            for state in all_states:
-                if state in states_w_transitions:
-                    values.append(states_w_transitions[state].answer)
-                else:
-                    values.append("")
-            w.writerow(values)
-        # rewind the virtual file
-        output.seek(0)
-        response = HttpResponse(output.read(), content_type='application/ms-excel')
-        response["content-disposition"] = "attachment; filename=%s.csv" % tree.trigger
+        cursor = exports.get_cursor(tree, since)
+        until = cursor if since is not None else None
+        if parquet:
+            try:
+                chunks = exports.parquet_chunks(tree, all_states, archived=archived,
+                                                since=since, until=until)
+            except ImproperlyConfigured:
+                return HttpResponseBadRequest("Parquet exports are not available.")
+            response = StreamingHttpResponse(chunks, content_type='application/octet-stream')
+            response["content-disposition"] = "attachment; filename=%s.parquet" % tree.trigger
+        else:
+            rows = exports.survey_rows(tree, all_states, archived=archived,
+                                       since=since, until=until)
+            response = StreamingHttpResponse(exports.csv_lines(rows),
+                                             content_type='application/ms-excel')
+            response["content-disposition"] = "attachment; filename=%s.csv" % tree.trigger
+        # pass back as ?since= to export what changed next
+        response["X-Export-Cursor"] = exports.format_cursor(cursor)
         return response
 
 
+class SurveyExportJob(base.TreeDetailView):
+    """Reports the progress of a background export, or downloads it."""
+    model = models.Tree
+
+    def get(self, request, *args, **kwargs):
+        tree = self.get_object()
+        job = get_object_or_404(tree.export_jobs, pk=kwargs['job_id'])
+        if request.GET.get('download'):
+            if not job.is_available():
+                raise Http404("The export isn't available.")
+            export = job.file.storage.open(job.file.name, 'rb')
+            response = FileResponse(export, content_type='application/ms-excel')
+            response["content-disposition"] = "attachment; filename=%s.csv" % tree.trigger
+            return response
+        data = {
+            'status': job.status,
+            'rows': job.rows,
+            'total': job.total,
+            'download': None,
+        }
+        if job.status == models.ExportJob.DONE:
+            data['download'] = request.path + '?download=1'
+        return JsonResponse(data)
+
+
 class SurveyReport(base.TreeDetailView):
     model = models.Tree
     template_name = "tree/surveys/report.html"
 
     def get_context_data(self, **kwargs):
         tree = self.object
-        tag = None
         form = forms.AnswerSearchForm(self.request.GET, tree=tree)
-        entry_tags = models.Entry.tags.through.objects
-        entry_tags = entry_tags.filter(entry__session__tree=tree)
-        entry_tags = entry_tags.select_related('tag')
-        tag_map = {}
-        for entry_tag in entry_tags:
-            if entry_tag.entry_id not in tag_map:
-                tag_map[entry_tag.entry_id] = []
-            tag_map[entry_tag.entry_id].append(entry_tag.tag)
-        # pre-fetch all entries for this tree and create a map so we can
-        # efficiently pair everything up in Python, rather than lots of SQL
-        entries = models.Entry.objects.filter(session__tree=tree).select_related()
-        if tag:
-            entries = entries.filter(tags=tag)
-        entry_map = {}
-        for entry in entries:
-            entry.cached_tags = tag_map.get(entry.pk, [])
-            state = entry.transition.current_state
-            if entry.session.pk not in entry_map:
-                entry_map[entry.session.pk] = {}
-            entry_map[entry.session.pk][state.pk] = entry
+        before = self.request.GET.get('before')
+        if before is not None:
+            if not before.isdigit():
+                raise Http404
+            before = get_object_or_404(tree.sessions.only('pk', 'start_date'), pk=before)
         states = tree.get_all_states()
-        sessions = tree.sessions.select_related('connection__contact',
-                                                'connection__backend')
-        sessions = sessions.order_by('-start_date')
-        columns = OrderedDict()
-        for state in states:
-            columns[state.pk] = []
-        # for each session, created an ordered list of (state, entry) pairs
-        # using the map from above. this will ease template display.
-        for session in sessions:
-            session.ordered_states = []
-            for state in states:
-                try:
-                    entry = entry_map[session.pk][state.pk]
-                except KeyError:
-                    entry = None
-                session.ordered_states.append((state, entry))
-                if entry:
-                    columns[state.pk].append(entry.text)
-        # count answers grouped by state
-        stats = models.Transition.objects.filter(entries__session__tree=tree,
-                                                 entries__in=[e.pk for e in entries])
-        stats = stats.values('current_state', 'answer__name')
-        stats = stats.annotate(count=Count('answer'))
-        stat_map = {}
-        for stat in stats:
-            current_state = stat['current_state']
-            answer = stat['answer__name']
-            count = stat['count']
-            if current_state not in stat_map:
-                stat_map[current_state] = {'answers': {}, 'total': 0}
-            stat_map[current_state]['answers'][answer] = count
-            stat_map[current_state]['total'] += count
-            stat_map[current_state]['values'] = columns[current_state]
+        sessions, more = reports.session_page(tree, states, before)
+        stats = reports.answer_stats(tree)
         for state in states:
-            state.stats = stat_map.get(state.pk, {})
+            state.stats = stats.get(state.pk, {})
         kwargs.update({
             'form': form,
             'tree': tree,
             'sessions': sessions,
             'states': states,
+            'first_page': before is None,
+            'next_before': sessions[-1].pk if more else None,
         })
         return super(SurveyReport, self).get_context_data(**kwargs)
 
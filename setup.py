@@ -28,5 +28,10 @@ setup(
     install_requires=[
         'RapidSMS>=0.19.0',
         'django-colorful>=1.0.1',
+        # concurrent.futures, for the digest worker pool
+        'futures>=3.0; python_version < "3"',
     ],
+    extras_require={
+        'parquet': ['pyarrow'],
+    },
 )